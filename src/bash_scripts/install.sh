@@ -3,4 +3,5 @@ pip install --upgrade google-api-python-client pydrive
 pip install --upgrade google-cloud-bigquery google-cloud-storage google-cloud-bigquery-storage
 pip install --upgrade google-cloud-secret-manager google-auth google-auth-oauthlib google-auth-httplib2
 pip install --upgrade colorama
+pip install --upgrade requests orjson ijson pyarrow aiohttp
 
@@ -39,7 +39,7 @@ trap 'interrupted' SIGINT SIGTERM
 	cd /home/isams_pipeline/ || exit 1
 	source myvenv/bin/activate
 	cd /home/isams_pipeline/ || exit 1
-	python iSAMS.py 2>&1
+	python iSAMS.py "$@" 2>&1
 	echo "===== END: $(date) ====="
 } | tee -a "$LOG_FILE"
 
@@ -0,0 +1,81 @@
+import os
+import glob
+import gzip
+import threading
+
+# pyarrow is only needed to count the rows of Parquet loads
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
+	pq = None
+
+'''
+In-memory stand-in for the BigQuery client
+
+Implements the client calls the pipeline makes (load_table_from_dataframe, load_table_from_file,
+load_table_from_uri, query) and records rows, bytes and load jobs per table instead of uploading anything.
+With local_bucket_dir (a Local_Bucket_Client root), gs:// loads count the rows of the matching local shards.
+'''
+
+class Fake_Job:
+	def __init__(self, job_type:str, table_id:str, rows:int=0, num_bytes:int=0):
+		self.job_type = job_type
+		self.table_id = table_id
+		self.output_rows = rows
+		self.input_file_bytes = num_bytes
+
+	def result(self):
+		return self
+
+class Fake_BQ_Client:
+	def __init__(self, project:str='benchmark-project', local_bucket_dir:str=None):
+		self.project = project
+		self.local_bucket_dir = local_bucket_dir
+		self.jobs = []
+		self.tables = {}
+		self._lock = threading.Lock()
+
+	def _record(self, job:Fake_Job, write_disposition:str=None) -> Fake_Job:
+		with self._lock:
+			self.jobs.append(job)
+			table = self.tables.setdefault(job.table_id, {'rows': 0, 'bytes': 0, 'load_jobs': 0})
+			if write_disposition == 'WRITE_TRUNCATE':
+				table['rows'] = 0
+				table['bytes'] = 0
+			table['rows'] += job.output_rows
+			table['bytes'] += job.input_file_bytes
+			table['load_jobs'] += job.job_type == 'load'
+		return job
+
+	def load_table_from_dataframe(self, df, table_id:str, job_config=None):
+		num_bytes = int(df.memory_usage(deep=False).sum())
+		return self._record(Fake_Job('load', table_id, len(df), num_bytes), getattr(job_config, 'write_disposition', None))
+
+	def load_table_from_file(self, file_obj, table_id:str, job_config=None, **kwargs):
+		rows = 0
+		content = file_obj.read()
+		if getattr(job_config, 'source_format', None) == 'PARQUET' and pq is not None:
+			rows = pq.read_metadata(pa.BufferReader(content)).num_rows
+		return self._record(Fake_Job('load', table_id, rows, len(content)), getattr(job_config, 'write_disposition', None))
+
+	def load_table_from_uri(self, source_uris, destination:str, job_config=None, **kwargs):
+		rows = 0
+		num_bytes = 0
+		if self.local_bucket_dir:
+			for uri in ([source_uris] if isinstance(source_uris, str) else source_uris):
+				for path in sorted(glob.glob(os.path.join(self.local_bucket_dir, uri.removeprefix('gs://')))):
+					num_bytes += os.path.getsize(path)
+					if path.endswith('.parquet') and pq is not None:
+						rows += pq.read_metadata(path).num_rows
+					elif path.endswith('.gz'):
+						with gzip.open(path, 'rt', encoding='utf-8') as file:
+							rows += sum(1 for _ in file)
+		return self._record(Fake_Job('load', str(destination), rows, num_bytes), getattr(job_config, 'write_disposition', None))
+
+	def query(self, query:str, job_config=None, **kwargs):
+		return self._record(Fake_Job('query', ''))
+
+	def load_jobs(self, table_id:str=None) -> int:
+		return sum(1 for job in self.jobs if job.job_type == 'load' and (table_id is None or job.table_id == table_id))
@@ -0,0 +1,165 @@
+import os
+import sys
+import gzip
+import math
+import time
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# python_utils lives next to this folder in src/python_scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts'))
+from python_utils.formats import isams_dataset_endpoints
+
+# use orjson for encoding payloads when it is installed
+try:
+	from orjson import dumps as json_dumps
+except ImportError:
+	import json
+	def json_dumps(payload) -> bytes:
+		return json.dumps(payload).encode('utf-8')
+
+'''
+Local stand-in for the iSAMS REST API
+
+Serves every endpoint in isams_dataset_endpoints with synthetic rows generated from its BigQuery schema,
+using the same paginated contract as iSAMS (page, pageSize, totalCount, totalPages and the endpoint object).
+Rows are generated on request, so large row counts do not need to fit in memory.
+'''
+
+# synthetic value for a BigQuery field, row_id makes values differ between rows
+def synthetic_value(field, row_id:int):
+	if field.field_type in ('RECORD', 'STRUCT'):
+		value = {sub_field.name: synthetic_value(sub_field, row_id) for sub_field in field.fields}
+	elif field.field_type in ('INTEGER', 'INT64'):
+		value = row_id
+	elif field.field_type in ('FLOAT', 'FLOAT64'):
+		value = row_id * 0.5
+	elif field.field_type in ('BOOLEAN', 'BOOL'):
+		value = row_id % 2 == 0
+	elif field.field_type in ('DATE', 'DATETIME', 'TIMESTAMP'):
+		value = f'20{row_id % 25:02d}-{row_id % 12 + 1:02d}-{row_id % 28 + 1:02d}T{row_id % 24:02d}:00:00Z'
+	else:
+		value = f'{field.name}_{row_id}'
+
+	if field.mode == 'REPEATED':
+		return [value, value]
+	return value
+
+def synthetic_row(schema:list, row_id:int) -> dict:
+	return {field.name: synthetic_value(field, row_id) for field in schema}
+
+class Mock_iSAMS_Server:
+	# rows: number of rows served per endpoint (single-page endpoints serve them all in one page)
+	# latency: seconds added to every API request
+	def __init__(self, rows:int=10000, latency:float=0.0, host:str='127.0.0.1', port:int=0, endpoints:dict=None):
+		self.rows = rows
+		self.latency = latency
+		self.endpoints = endpoints or isams_dataset_endpoints
+		self.routes = {f"/{endpoint_info['url'].strip('/')}": endpoint_info for endpoint_info in self.endpoints.values()}
+
+		self.requests = 0
+		self.bytes_sent = 0
+		self._lock = threading.Lock()
+		self.httpd = ThreadingHTTPServer((host, port), self._handler())
+		self.httpd.daemon_threads = True
+		self._thread = None
+
+	@property
+	def base_url(self) -> str:
+		host, port = self.httpd.server_address[:2]
+		return f'http://{host}:{port}'
+
+	@property
+	def token_url(self) -> str:
+		return f'{self.base_url}/oauth/token'
+
+	def start(self):
+		self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *exc_info):
+		self.stop()
+
+	# response body for a GET request, None if the path is unknown
+	def page_payload(self, path:str, query:dict):
+		endpoint_info = self.routes.get(f"/{path.strip('/')}")
+		if endpoint_info is None:
+			return None
+
+		if endpoint_info['pages'] == 'multi-page':
+			page = int(query.get('page', ['1'])[0])
+			page_size = int(query.get('pageSize', ['100'])[0])
+		else:
+			page, page_size = 1, max(self.rows, 1)
+
+		first_row = (page - 1) * page_size
+		last_row = min(first_row + page_size, self.rows)
+		return {
+			'page': page,
+			'pageSize': page_size,
+			'totalCount': self.rows,
+			'totalPages': math.ceil(self.rows / page_size),
+			endpoint_info['object']: [synthetic_row(endpoint_info['schema'], row_id) for row_id in range(first_row + 1, last_row + 1)],
+		}
+
+	def _handler(self):
+		server = self
+
+		class Handler(BaseHTTPRequestHandler):
+			protocol_version = 'HTTP/1.1'
+
+			def log_message(self, *args):
+				pass
+
+			def send_json(self, status:int, payload:dict):
+				body = json_dumps(payload)
+				self.send_response(status)
+				self.send_header('Content-Type', 'application/json')
+				if 'gzip' in self.headers.get('Accept-Encoding', ''):
+					body = gzip.compress(body, compresslevel=1)
+					self.send_header('Content-Encoding', 'gzip')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+				with server._lock:
+					server.requests += 1
+					server.bytes_sent += len(body)
+
+			def do_POST(self):
+				self.rfile.read(int(self.headers.get('Content-Length', 0)))
+				if urlparse(self.path).path != '/oauth/token':
+					self.send_json(404, {'message': 'Not found'})
+					return
+				self.send_json(200, {'access_token': 'benchmark-token', 'token_type': 'Bearer', 'expires_in': 3600})
+
+			def do_GET(self):
+				if server.latency:
+					time.sleep(server.latency)
+
+				if not self.headers.get('Authorization', '').startswith('Bearer '):
+					self.send_json(401, {'message': 'The user is not authorised for this request'})
+					return
+
+				url = urlparse(self.path)
+				payload = server.page_payload(url.path, parse_qs(url.query))
+				if payload is None:
+					self.send_json(404, {'message': 'Not found'})
+				else:
+					self.send_json(200, payload)
+
+		return Handler
+
+if __name__ == '__main__':
+	with Mock_iSAMS_Server(rows=int(sys.argv[1]) if len(sys.argv) > 1 else 10000, port=8080) as mock_server:
+		print(f'Mock iSAMS API on {mock_server.base_url} (token URL {mock_server.token_url})')
+		threading.Event().wait()
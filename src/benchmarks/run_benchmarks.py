@@ -0,0 +1,276 @@
+import os
+import sys
+import json
+import time
+import queue
+import asyncio
+import argparse
+import resource
+import tempfile
+import itertools
+import subprocess
+import threading
+import contextlib
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+# python_utils lives next to this folder in src/python_scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts'))
+import pandas as pd
+from python_utils.formats import isams_dataset_endpoints
+from python_utils.json import configure_api_client, Token_Provider, api_request, api_get_columns
+from python_utils.async_api import Async_API_Client, async_api_get_raw
+from python_utils.modify_cols import transform_df
+from python_utils.bigquery import BQ_Buffered_Loader
+from python_utils.context import Pipeline_Context, set_context
+from mock_isams import Mock_iSAMS_Server
+from fake_bigquery import Fake_BQ_Client
+
+'''
+End-to-end benchmarks
+
+Runs the pipeline against a local mock of the iSAMS API and an in-memory BigQuery client, and reports rows/sec,
+wall time per stage and peak RSS for every endpoint, row count and engine. Each case runs in its own process so
+peak RSS is measured per case.
+
+The pipeline engines run iSAMS.main() for the endpoint, with the mock secret and the fake client passed in
+through the pipeline context, so the scheduler, Endpoint_Load, the staged pipeline and adaptive paging are the
+code that runs nightly. Their stage times come from the metrics of the run. The baseline engines are standalone
+fetch/transform/load loops over the same python_utils calls, kept as a reference for the pipeline overhead.
+
+	python run_benchmarks.py --endpoints students alumni school_terms --rows 10000 100000 1000000
+'''
+
+# sync: iSAMS.py --mode sync, concurrent: the same with 'concurrency' pages in parallel,
+# stream: the same with stream_decode, async: iSAMS.py --mode async
+ENGINES = ['sync', 'concurrent', 'stream', 'async']
+BASELINE_ENGINES = ['baseline-sync', 'baseline-concurrent', 'baseline-stream', 'baseline-async']
+STAGES = ['fetch', 'decode', 'build', 'transform', 'load']
+
+class Stage_Timer:
+	def __init__(self):
+		self.seconds = defaultdict(float)
+
+	def time(self, stage:str, func, *args):
+		start_time = time.perf_counter()
+		result = func(*args)
+		self.seconds[stage] += time.perf_counter() - start_time
+		return result
+
+# raw page bodies in page order, fetched one at a time
+def sync_pages(token_provider, full_api_path:str, params_list:list, concurrency:int):
+	for params in params_list:
+		yield api_request(token_provider, full_api_path, params=params).content
+
+# raw page bodies in page order, fetched on a thread pool
+def concurrent_pages(token_provider, full_api_path:str, params_list:list, concurrency:int):
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		yield from executor.map(lambda params: api_request(token_provider, full_api_path, params=params).content, params_list)
+
+# raw page bodies in page order, fetched on an event loop in a background thread
+def async_pages(token_provider, full_api_path:str, params_list:list, concurrency:int):
+	page_queue = queue.Queue(maxsize=8)
+
+	async def produce():
+		async with Async_API_Client(max_connections=concurrency) as client:
+			params_iter = iter(params_list)
+			in_flight = deque(
+				asyncio.create_task(async_api_get_raw(token_provider, full_api_path, client, params=params))
+				for params in itertools.islice(params_iter, client.max_in_flight)
+			)
+			while in_flight:
+				content = await in_flight.popleft()
+				next_params = next(params_iter, None)
+				if next_params is not None:
+					in_flight.append(asyncio.create_task(async_api_get_raw(token_provider, full_api_path, client, params=next_params)))
+				await asyncio.to_thread(page_queue.put, content)
+		page_queue.put(None)
+
+	producer = threading.Thread(target=asyncio.run, args=(produce(),), daemon=True)
+	producer.start()
+	while (content := page_queue.get()) is not None:
+		yield content
+	producer.join()
+
+PAGE_SOURCES = {'sync': sync_pages, 'concurrent': concurrent_pages, 'async': async_pages}
+
+# run one (endpoint, rows, engine) case through iSAMS.main() and return its measurements
+def run_pipeline_case(endpoint:str, rows:int, engine:str, latency:float, page_size:int, concurrency:int) -> dict:
+	# state (watermarks, page sizes, checkpoints) and metrics of the case go to a temporary folder, so every case is a first full run
+	work_dir = tempfile.mkdtemp(prefix='isams_benchmark_')
+	import python_utils.state as state
+	state.STATE_DIR = os.path.join(work_dir, 'state')
+	import iSAMS
+	iSAMS.METRICS_PATH = os.path.join(work_dir, 'metrics.jsonl')
+	iSAMS.ASYNC_MAX_CONNECTIONS = concurrency
+
+	endpoint_info = iSAMS.isams_dataset_endpoints[endpoint]
+	endpoint_info['paging'] = {**endpoint_info.get('paging', {}), 'page_size': page_size}
+	endpoint_info['concurrency'] = concurrency if engine == 'concurrent' else 1
+	endpoint_info['stream_decode'] = engine == 'stream'
+
+	fake_bq = Fake_BQ_Client()
+	with Mock_iSAMS_Server(rows=rows, latency=latency) as mock_server:
+		set_context(Pipeline_Context(
+			secret={'CLIENT_ID': 'benchmark', 'CLIENT_SECRET': 'benchmark', 'TOKEN_URL': mock_server.token_url, 'API_BASE_URL': mock_server.base_url},
+			bq_client=fake_bq,
+		))
+
+		# pipeline logs go to stderr, stdout only carries the result
+		start_time = time.perf_counter()
+		with contextlib.redirect_stdout(sys.stderr):
+			iSAMS.main(iSAMS.parse_args(['--endpoints', endpoint, '--mode', 'async' if engine == 'async' else 'sync']))
+		wall_time = time.perf_counter() - start_time
+
+	with open(iSAMS.METRICS_PATH, 'r', encoding='utf-8') as file:
+		summary = [record for record in map(json.loads, file) if record['type'] == 'endpoint'][-1]
+	stages = {stage: totals['duration'] for stage, totals in summary['stages'].items()}
+	stages['load'] = stages.pop('load_submit', 0.0) + stages.pop('load_wait', 0.0)
+
+	rows_loaded = fake_bq.tables.get(endpoint_info['table_id'], {}).get('rows', 0)
+	return {
+		'endpoint': endpoint,
+		'rows': rows,
+		'engine': engine,
+		'rows_loaded': rows_loaded,
+		'wall_time': wall_time,
+		'rows_per_sec': rows_loaded / wall_time if wall_time else 0.0,
+		'stages': stages,
+		'api_requests': mock_server.requests,
+		'api_bytes': mock_server.bytes_sent,
+		'load_jobs': fake_bq.load_jobs(),
+		# ru_maxrss is in KiB on Linux
+		'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+	}
+
+# run one (endpoint, rows, engine) case with a standalone fetch/transform/load loop and return its measurements
+def run_baseline_case(endpoint:str, rows:int, engine:str, latency:float, page_size:int, concurrency:int) -> dict:
+	source = engine.removeprefix('baseline-')
+	endpoint_info = isams_dataset_endpoints[endpoint]
+	schema = endpoint_info['schema']
+	fake_bq = Fake_BQ_Client()
+	timer = Stage_Timer()
+
+	with Mock_iSAMS_Server(rows=rows, latency=latency) as mock_server:
+		client = configure_api_client(pool_size=concurrency)
+		token_provider = Token_Provider(mock_server.token_url, 'benchmark', 'benchmark', mock_server.base_url)
+		full_api_path = f"{mock_server.base_url}/{endpoint_info['url']}"
+
+		start_time = time.perf_counter()
+		timer.time('token', token_provider.get_token)
+
+		if endpoint_info['pages'] == 'multi-page':
+			total_pages = max(-(-rows // page_size), 1)
+			params_list = [{'page': page, 'pageSize': page_size} for page in range(1, total_pages + 1)]
+		else:
+			params_list = [None]
+
+		loader = BQ_Buffered_Loader(fake_bq, endpoint_info['table_id'], schema=schema, load_format=endpoint_info.get('load_format', 'dataframe'))
+
+		if source == 'stream':
+			pages = (
+				api_get_columns(token_provider, full_api_path, endpoint_info['object'], [field.name for field in schema], params=params)[0]
+				for params in params_list
+			)
+		else:
+			pages = PAGE_SOURCES[source](token_provider, full_api_path, params_list, concurrency)
+
+		rows_loaded = 0
+		while True:
+			# waiting on the page source is the fetch stage (fetch + decode to columns for the stream engine)
+			page = timer.time('fetch', next, pages, None)
+			if page is None:
+				break
+
+			if source == 'stream':
+				page_df = timer.time('build', pd.DataFrame, page)
+			else:
+				payload = timer.time('decode', client.decode, page)
+				page_df = timer.time('build', pd.DataFrame, payload[endpoint_info['object']])
+
+			page_df = timer.time('transform', transform_df, page_df, schema, endpoint_info.get('null_cols'))
+			timer.time('load', loader.add, page_df)
+			rows_loaded += len(page_df)
+
+		timer.time('load', loader.close)
+		wall_time = time.perf_counter() - start_time
+
+	return {
+		'endpoint': endpoint,
+		'rows': rows,
+		'engine': engine,
+		'rows_loaded': rows_loaded,
+		'wall_time': wall_time,
+		'rows_per_sec': rows_loaded / wall_time if wall_time else 0.0,
+		'stages': dict(timer.seconds),
+		'api_requests': mock_server.requests,
+		'api_bytes': mock_server.bytes_sent,
+		'load_jobs': fake_bq.load_jobs(),
+		# ru_maxrss is in KiB on Linux
+		'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+	}
+
+def run_case(endpoint:str, rows:int, engine:str, latency:float, page_size:int, concurrency:int) -> dict:
+	if engine in BASELINE_ENGINES:
+		return run_baseline_case(endpoint, rows, engine, latency, page_size, concurrency)
+	return run_pipeline_case(endpoint, rows, engine, latency, page_size, concurrency)
+
+# run a case in a child process so its peak RSS is not inflated by earlier cases
+def run_case_isolated(endpoint:str, rows:int, engine:str, args) -> dict:
+	command = [
+		sys.executable, os.path.abspath(__file__), '--case',
+		'--endpoints', endpoint, '--rows', str(rows), '--engines', engine,
+		'--latency', str(args.latency), '--page-size', str(args.page_size), '--concurrency', str(args.concurrency),
+	]
+	completed = subprocess.run(command, capture_output=True, text=True)
+	if completed.returncode != 0:
+		return {'endpoint': endpoint, 'rows': rows, 'engine': engine, 'error': completed.stderr.strip().splitlines()[-1:]}
+	return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def print_report(results:list):
+	header = f"{'endpoint':<15}{'rows':>10}  {'engine':<20}{'rows/s':>10}{'wall s':>9}" + ''.join(f'{stage:>10}' for stage in ['token'] + STAGES) + f"{'jobs':>6}{'RSS MB':>9}"
+	print(header)
+	print('-' * len(header))
+	for result in results:
+		if 'error' in result:
+			print(f"{result['endpoint']:<15}{result['rows']:>10}  {result['engine']:<20}  failed: {result['error']}")
+			continue
+		stages = ''.join(f"{result['stages'].get(stage, 0.0):>10.2f}" for stage in ['token'] + STAGES)
+		print(
+			f"{result['endpoint']:<15}{result['rows']:>10}  {result['engine']:<20}{result['rows_per_sec']:>10.0f}{result['wall_time']:>9.2f}"
+			+ stages + f"{result['load_jobs']:>6}{result['peak_rss_mb']:>9.0f}"
+		)
+
+def parse_args(argv:list=None):
+	parser = argparse.ArgumentParser(description='Benchmark the iSAMS pipeline against a local mock API and a fake BigQuery client')
+	parser.add_argument('--endpoints', nargs='+', default=['students', 'alumni', 'school_terms'], choices=list(isams_dataset_endpoints))
+	parser.add_argument('--rows', nargs='+', type=int, default=[10000, 100000, 1000000])
+	parser.add_argument('--engines', nargs='+', default=ENGINES + ['baseline-sync'], choices=ENGINES + BASELINE_ENGINES)
+	parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every API request')
+	parser.add_argument('--page-size', type=int, default=1000, help='first page size, the pipeline engines adapt it during the run')
+	parser.add_argument('--concurrency', type=int, default=4, help='parallel requests for the concurrent and async engines')
+	parser.add_argument('--json', metavar='PATH', help='also write the results as JSON lines to PATH')
+	parser.add_argument('--case', action='store_true', help=argparse.SUPPRESS)
+	return parser.parse_args(argv)
+
+def main(args):
+	# child process: run exactly one case and print it as JSON
+	if args.case:
+		result = run_case(args.endpoints[0], args.rows[0], args.engines[0], args.latency, args.page_size, args.concurrency)
+		print(json.dumps(result))
+		return
+
+	results = []
+	for endpoint, rows, engine in itertools.product(args.endpoints, args.rows, args.engines):
+		results.append(run_case_isolated(endpoint, rows, engine, args))
+		print(f"{endpoint} {rows} {engine}: {'failed' if 'error' in results[-1] else 'done'}", file=sys.stderr)
+
+	print_report(results)
+
+	if args.json:
+		with open(args.json, 'w', encoding='utf-8') as file:
+			for result in results:
+				file.write(json.dumps(result) + '\n')
+
+if __name__ == '__main__':
+	main(parse_args())
@@ -2,66 +2,64 @@ import sys
 import functools
 import pandas as pd
 from datetime import datetime
-from google.oauth2 import service_account
-from google.cloud import storage, bigquery as bq
+from concurrent.futures import ThreadPoolExecutor
 from colorama import Fore, Back, Style
 
 # append the path leading to python_utils, e.g. python_utils is in /home/working_directory/python_utils
 sys.path.append("/home/working_directory")
-from python_utils.secret_manager import get_secret
+from python_utils.context import get_context
 from python_utils.bigquery import *
 from python_utils.utils import *
 from python_utils.formats import *
 from python_utils.json import *
 from python_utils.modify_cols import *
-from gis_custom import *
 
 # force flushing to ensure logs appear in log file immediately during execution
-sys.stdout = open(sys.stdout.fileno(), 'w', buffering=1)
-sys.stderr = open(sys.stderr.fileno(), 'w', buffering=1)
 print = functools.partial(print, flush=True)
-PYTHONUNBUFFERED = True
 
-# Service Account Credentials
-KEY_PATH = "Path to folder containing Service Account Keys"
-KEY_NAME = 'Service Account JSON key file'
-SERVICE_ACC_KEY = f'{KEY_PATH}/{KEY_NAME}'
+# year group divisions are fetched concurrently, one request per year group
+DIVISIONS_CONCURRENCY = 16
 
-# retrieve Service Account credentials
-# build BigQuery API Client
-service_acc_creds = service_account.Credentials.from_service_account_file(SERVICE_ACC_KEY)
-bq_client = bq.Client(credentials=service_acc_creds, project=service_acc_creds.project_id)
+# year group IDs (ncYear) from the year_groups endpoint
+def get_year_group_ids(token_provider:Token_Provider) -> list:
+	year_groups_info = isams_dataset_endpoints['year_groups']
+	api_response = api_get(token_provider, api_url=f"{get_context().api_base_url}/{year_groups_info['url']}", content_type='application/json')
+	return sorted({year_group['ncYear'] for year_group in api_response[year_groups_info['object']]})
 
-# retrieve OAuth2 client credentials from Secret Manager
-SECRET_ID = "isams_api_credentials"
-secret_payload = get_secret(SECRET_ID, service_acc_creds.project_id, service_acc_creds)
+def fetch_divisions(token_provider:Token_Provider, year_group_id:int) -> pd.DataFrame:
+	api_response = api_get(token_provider, api_url=f'{get_context().api_base_url}/api/school/yeargroups/{year_group_id}/divisions', content_type='application/json')
+	endpoint_object = api_response['divisions']
 
-# Set OAuth2 client credentials
-CLIENT_ID = secret_payload["CLIENT_ID"]
-CLIENT_SECRET = secret_payload["CLIENT_SECRET"]
-TOKEN_URL = secret_payload["TOKEN_URL"]
-API_BASE_URL = secret_payload["API_BASE_URL"]
+	cur_df = pd.DataFrame(endpoint_object)
+	cur_df['year_group_id'] = year_group_id
+	return cur_df
 
 def year_group_division():
-	access_token = gen_access_token(TOKEN_URL, CLIENT_ID, CLIENT_SECRET, API_BASE_URL)
-	for id in range(-2, 14+1):
-		api_response = api_get(access_token, api_url=f'{API_BASE_URL}/api/school/yeargroups/{id}/divisions', content_type='application/json')
-		endpoint_object = api_response['divisions']
-		
-		cur_df = pd.DataFrame(endpoint_object)
-		cur_df['year_group_id'] = id
-		
-		print(cur_df)
-		df_to_bq(
-			bq_client=bq_client,
-			df=cur_df,
-			table_id='taylors-data-poc.isams_data.divisions',
-			mode='t' if id == -2 else 'a',
-			autodetect=True
-		)
+	# reuses the token already issued to iSAMS.py when both run in the same process
+	token_provider = get_context().token_provider
+	year_group_ids = get_year_group_ids(token_provider)
+
+	# fan out one request per year group, then load everything in one truncating load job
+	with ThreadPoolExecutor(max_workers=min(DIVISIONS_CONCURRENCY, max(len(year_group_ids), 1))) as executor:
+		division_dfs = list(executor.map(lambda year_group_id: fetch_divisions(token_provider, year_group_id), year_group_ids))
+
+	divisions_df = pd.concat(division_dfs, ignore_index=True) if division_dfs else pd.DataFrame()
+	print(f'{datetime.now()} {len(divisions_df)} divisions across {len(year_group_ids)} year groups')
+
+	df_to_bq(
+		bq_client=get_context().bq_client,
+		df=divisions_df,
+		table_id='taylors-data-poc.isams_data.divisions',
+		mode='t',
+		autodetect=True
+	)
 
 def custom_pipelines():
 	year_group_division()
 
 if __name__ == '__main__':
+	# line buffering, so logs appear in the log file immediately during execution
+	sys.stdout.reconfigure(line_buffering=True)
+	sys.stderr.reconfigure(line_buffering=True)
+
 	custom_pipelines()
\ No newline at end of file
@@ -1,200 +1,868 @@
 import sys
+import math
+import time
+import asyncio
+import itertools
+import signal
+import argparse
 import functools
+import threading
 import pandas as pd
 from datetime import datetime
-from google.oauth2 import service_account
-from google.cloud import storage, bigquery as bq
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from colorama import Fore, Back, Style
 
 # append the path leading to python_utils, e.g. python_utils is in /home/working_directory/python_utils
 sys.path.append("/home/working_directory")
-from python_utils.secret_manager import get_secret
+from python_utils.context import get_context
 from python_utils.bigquery import *
+from python_utils.gcs_bucket import GCS_Stage_Loader, DEFAULT_GCS_STAGE
+from python_utils.nested import nested_fields, parent_schema, split_nested
 from python_utils.utils import *
 from python_utils.formats import *
 from python_utils.json import *
 from python_utils.modify_cols import *
+from python_utils.incremental import Incremental_Load, WATERMARK_STATE
+from python_utils.paging import Adaptive_Page_Size, Recorded_Page_Size
+from python_utils.pipeline import Pipeline
+from python_utils.fingerprint import payload_fingerprint, is_unchanged, save_fingerprint
+from python_utils.scheduler import run_scheduled
+from python_utils.state import load_state, save_state, clear_state
+from python_utils.response_cache import Response_Cache
+from python_utils.async_api import Async_API_Client, async_api_get_raw
+from python_utils.metrics import Metrics_Log, Endpoint_Metrics, timed, METRICS_PATH
 from custom import *
 
 # force flushing to ensure logs appear in log file immediately during execution
-sys.stdout = open(sys.stdout.fileno(), 'w', buffering=1)
-sys.stderr = open(sys.stderr.fileno(), 'w', buffering=1)
 print = functools.partial(print, flush=True)
-PYTHONUNBUFFERED = True
 
-# Service Account Credentials
-KEY_PATH = "Path to folder containing Service Account Keys"
-KEY_NAME = 'Service Account JSON key file'
-SERVICE_ACC_KEY = f'{KEY_PATH}/{KEY_NAME}'
+# HTTP client settings shared by every API request in the run
+# pool size should cover the page 'concurrency' of the endpoints running at the same time
+API_POOL_SIZE = 10
+API_TIMEOUT = (10, 120) # (connect, read) in seconds
+API_HEADERS = None
 
-# retrieve Service Account credentials
-service_acc_creds = service_account.Credentials.from_service_account_file(SERVICE_ACC_KEY)
+# raw response cache (--cache to record, --replay RUN_ID to re-run from it)
+RESPONSE_CACHE_DIR = '/home/isams_pipeline/response_cache'
+RESPONSE_CACHE_MAX_BYTES = 2 * 1024**3
+RESPONSE_CACHE_MAX_AGE = 7 * 24 * 3600 # seconds
 
-# retrieve OAuth2 client credentials from Secret Manager
-SECRET_ID = "isams_api_credentials"
-secret_payload = get_secret(SECRET_ID, service_acc_creds.project_id, service_acc_creds)
+# number of endpoints processed at the same time
+MAX_CONCURRENT_ENDPOINTS = 3
 
-# Set OAuth2 client credentials
-CLIENT_ID = secret_payload["CLIENT_ID"]
-CLIENT_SECRET = secret_payload["CLIENT_SECRET"]
-TOKEN_URL = secret_payload["TOKEN_URL"]
-API_BASE_URL = secret_payload["API_BASE_URL"]
+# pages waiting between the fetch, transform and load stages of a multi-page endpoint, per queue
+PIPELINE_QUEUE_SIZE = 4
 
-# build BigQuery API Client
-bq_client = bq.Client(credentials=service_acc_creds, project=service_acc_creds.project_id)
+# async engine (--mode async): many requests in flight over a few connections
+ASYNC_MAX_CONNECTIONS = 4
+ASYNC_MAX_IN_FLIGHT = 200
+ASYNC_QUEUE_SIZE = 8 # pages waiting to be transformed, and to be loaded, per endpoint
 
-# get the total number of objects in JSON payload from multi-page endpoints
-def get_totalCount(access_token:str, full_api_path:str):
-	params = {'page': 1, 'pageSize': 1}
-	response = api_get(access_token, api_url=full_api_path, content_type=None, params=params)
+# identifies this run in checkpoints
+RUN_ID = datetime.now().strftime('%Y%m%d_%H%M%S')
+CHECKPOINT_STATE = 'checkpoints'
 
+# set on SIGTERM, endpoints stop before their next page
+STOP_EVENT = threading.Event()
+
+# transform data for each endpoint - column types are coerced from the endpoint schema
+def mod_endpoints(endpoint, df:pd.DataFrame):
+	endpoint_info = isams_dataset_endpoints[endpoint]
+	return transform_df(df, endpoint_info['schema'], null_cols=endpoint_info.get('null_cols'))
+
+# report why an API response does not contain the expected object
+def diagnose_response(full_api_path:str, api_response:dict, error:Exception):
+	print(Fore.RED + f"{datetime.now()} Error reading from '{full_api_path}.' Diagnosing...")
+	if 'message' in list(api_response.keys()) and api_response['message'] in "The user is not authorised for this request":
+		print(Fore.RED + f'Insufficient permission\n\n{error}')
+
+# read the endpoint object (list of dicts) from a decoded API response
+def read_endpoint_object(full_api_path:str, endpoint_info:dict, api_response:dict) -> list:
 	try:
-		totalCount = response.get('totalCount', 0)
-		totalPages = response.get('totalPages', 0)
+		return api_response[endpoint_info['object']]
 	except Exception as error:
-		print(Fore.RED + f"Failed to get totalCount for '{full_api_path}'\n{error}")
+		diagnose_response(full_api_path, api_response, error)
 		raise
 
-	if totalCount < 1 or totalPages < 1:
-		print(f"Warning! Query is empty for '{full_api_path}'")
-		print(f'totalCount = {totalCount}, totalPages = {totalPages}')
+# fetch the page of a multi-page endpoint starting at row offset (a multiple of page_size)
+# returns (page dataframe, meta): meta holds the top-level fields of the response (totalCount, totalPages, ...)
+# page_stats (optional dict) receives the seconds and bytes of the request, for the page size tuner
+# page metrics are keyed by offset, page numbers repeat when the page size changes during a run
+def fetch_page(token_provider:Token_Provider, full_api_path:str, endpoint_info:dict, offset:int, page_size:int, extra_params:dict=None, metrics:Endpoint_Metrics=None, page_stats:dict=None):
+	params = {'page': offset // page_size + 1, 'pageSize': page_size, **(extra_params or {})}
+	page_stats = {} if page_stats is None else page_stats
+	start_time = time.perf_counter()
+
+	# streaming decode: parse the body straight into per-column buffers keyed by the schema
+	# the body is decoded while it is received, so fetch and decode are one stage
+	if endpoint_info.get('stream_decode', False):
+		with timed(metrics, 'fetch', offset) as stats:
+			columns, meta = api_get_columns(
+				token_provider,
+				full_api_path,
+				object_key=endpoint_info['object'],
+				columns=[field.name for field in endpoint_info['schema']],
+				content_type='application/json',
+				params=params,
+				stats=stats
+			)
+			stats['rows'] = len(next(iter(columns.values()), []))
+		page_stats.update(seconds=time.perf_counter() - start_time, bytes=stats.get('bytes', 0))
+
+		if endpoint_info['object'] not in meta:
+			error = KeyError(endpoint_info['object'])
+			diagnose_response(full_api_path, meta, error)
+			raise error
+		with timed(metrics, 'build', offset) as stats:
+			page_df = pd.DataFrame(columns)
+			stats['rows'] = len(page_df)
+		return page_df, meta
+
+	# API request
+	with timed(metrics, 'fetch', offset) as stats:
+		content = api_get_raw(token_provider, full_api_path, content_type='application/json', params=params, stats=stats)
+	page_stats.update(seconds=time.perf_counter() - start_time, bytes=len(content))
 
-	return totalCount
+	with timed(metrics, 'decode', offset) as stats:
+		api_response = get_api_client().decode(content)
+		stats['bytes'] = len(content)
 
-# transform data for each endpoint
-def mod_endpoints(endpoint, df:pd.DataFrame):
-	match endpoint:
-		case 'applicants':
-			return applicants_mod(df)
-		case 'students':
-			return students_mod(df)
-		case 'alumni':
-			return alumni_mod(df)
-		case 'school_terms':
-			return school_terms_mod(df)
-		case 'year_groups':
-			return year_group_mod(df)
-		case 'billing_cycles':
-			return billing_cycles_mod(df)
-	
-	return df
+	# read API response
+	endpoint_object = read_endpoint_object(full_api_path, endpoint_info, api_response)
+	meta = {key: value for key, value in api_response.items() if key != endpoint_info['object']}
 
-# process API endpoints with multiple pages
-def multi_page_endpoint(access_token:str, full_api_path:str, endpoint:str, endpoint_info:dict, trunc_flag:bool):
-	# get total row count
-	totalCount = get_totalCount(access_token, full_api_path)
-
-	# iterate through all pages to extract all data
-	print(f'{datetime.now()} start upload')
-	cur_page = 1
-	page_size = 1000
-	while True:
-		print(
-			Fore.YELLOW
-			+ f'Processing {(cur_page * page_size) if (cur_page * page_size) < totalCount else totalCount} out of {totalCount}'
+	# extract API object (dict) and into dataframe
+	return build_page(endpoint_object, offset, metrics), meta
+
+# build the dataframe of a page, offset is the first row of the page (None for single-page endpoints)
+def build_page(endpoint_object:list, offset:int=None, metrics:Endpoint_Metrics=None) -> pd.DataFrame:
+	with timed(metrics, 'build', offset) as stats:
+		page_df = pd.DataFrame(endpoint_object)
+		stats['rows'] = len(page_df)
+	return page_df
+
+# yield fetch(request) for every request in order
+# concurrency > 1 fetches in parallel with at most max_ahead requests submitted ahead of the page being consumed
+# (default: concurrency), topped up as pages are consumed, so a slow consumer also holds back the fetches
+def iter_pages(fetch, requests, concurrency:int, max_ahead:int=None):
+	if concurrency <= 1:
+		yield from map(fetch, requests)
+		return
+
+	requests = iter(requests)
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		in_flight = deque(executor.submit(fetch, request) for request in itertools.islice(requests, max(max_ahead or concurrency, concurrency)))
+		try:
+			while in_flight:
+				page = in_flight.popleft().result()
+
+				next_request = next(requests, None)
+				if next_request is not None:
+					in_flight.append(executor.submit(fetch, next_request))
+
+				yield page
+		finally:
+			# pages not started yet are dropped when the consumer stops early
+			for future in in_flight:
+				future.cancel()
+
+# incremental state of an endpoint, None if it is not incremental
+# a replay reloads every cached row (full refresh) and leaves the watermark as it is
+def make_incremental(endpoint:str, endpoint_info:dict, replay:bool=False):
+	if not endpoint_info.get('incremental'):
+		return None
+	return Incremental_Load(endpoint, endpoint_info, full_refresh=replay, save_watermark=not replay)
+
+# load state of one multi-page endpoint, shared by the sync and async engines:
+# incremental filtering, checkpoint/resume, page sizes, the buffered loader and the page metrics
+# pages are tracked by row offset, since the page size can change during a run
+# response_cache records the requests of the run with its responses, or replays the recorded requests
+class Endpoint_Load:
+	def __init__(self, endpoint:str, endpoint_info:dict, trunc_flag:bool, resume:bool=False, metrics:Endpoint_Metrics=None, response_cache:Response_Cache=None):
+		self.endpoint = endpoint
+		self.endpoint_info = endpoint_info
+		self.trunc_flag = trunc_flag
+		self.metrics = metrics
+		self.totalCount = None
+		self.loader = None
+
+		self.response_cache = response_cache
+		self.replay = response_cache is not None and response_cache.replay
+		# page size requested at every offset, {offset: page size}, stored with the cached responses
+		self.requested = {}
+
+		# page size per request, adapted from observed latency and payload size
+		# a replay requests the page sizes of the recorded run, since cached responses are keyed by their pageSize
+		if self.replay:
+			recorded = response_cache.load_requests(endpoint)
+			if recorded is None:
+				raise LookupError(f'No requests of {endpoint} were recorded for run {response_cache.run_id}')
+			if recorded['params']:
+				raise ValueError(f"Run {response_cache.run_id} only fetched the rows of {endpoint} filtered by {recorded['params']}, it cannot be replayed as a full load")
+			self.page_sizes = Recorded_Page_Size(endpoint, recorded['page_sizes'], endpoint_info.get('paging'))
+		else:
+			self.page_sizes = Adaptive_Page_Size(endpoint, endpoint_info.get('paging'))
+
+		# incremental endpoints only load rows changed since the last watermark, via a staging table
+		self.incremental = make_incremental(endpoint, endpoint_info, self.replay)
+		self.load_table_id = self.incremental.load_table_id if self.incremental else endpoint_info['table_id']
+		self.extra_params = self.incremental.params() if self.incremental else None
+		if self.incremental and self.incremental.is_incremental:
+			print(f'Incremental load of {endpoint}: rows updated after {self.incremental.watermark}')
+			# the staging table is rebuilt on every run
+			self.trunc_flag = True
+
+		# objects and lists of objects split out into child tables, loaded alongside the parent (python_utils/nested.py)
+		self.nested = nested_fields(endpoint_info)
+		self.schema = parent_schema(endpoint_info['schema'], self.nested)
+		self.child_loaders = {}
+
+		# rows already loaded: continue an interrupted run from its checkpoint
+		self.offset = 0
+		self.checkpoint = load_state(CHECKPOINT_STATE, self.endpoint) if resume else None
+		if self.checkpoint:
+			if self.checkpoint.get('offset') is None or self.checkpoint['table_id'] != self.load_table_id or self.checkpoint['offset'] % self.page_sizes.ladder[0]:
+				print(Fore.YELLOW + f"Checkpoint of run {self.checkpoint['run_id']} cannot be resumed for {self.endpoint}, starting from the first page")
+				self.checkpoint = None
+			else:
+				self.offset = self.checkpoint['offset']
+
+	# set up the loader once totalCount is known (from the first page fetched)
+	# returns False if the checkpoint is stale, the first page must then be fetched again from offset 0
+	def start(self, totalCount:int) -> bool:
+		self.totalCount = totalCount
+		if totalCount < 1:
+			print(f'Warning! Query is empty for {self.endpoint}, totalCount = {totalCount}')
+
+		resumed = True
+		if self.checkpoint:
+			if self.checkpoint['total_count'] != totalCount:
+				print(Fore.YELLOW + f"totalCount for {self.endpoint} changed from {self.checkpoint['total_count']} to {totalCount} since run {self.checkpoint['run_id']}, starting from the first page")
+				self.offset = 0
+				resumed = False
+			else:
+				self.trunc_flag = False
+				print(Fore.YELLOW + f"Resuming {self.endpoint} after row {self.offset} (checkpoint of run {self.checkpoint['run_id']})")
+
+		# child loaders only load when the parent does, so one checkpoint covers the parent and child tables
+		self.loader = self.make_loader(self.load_table_id, self.schema, self.endpoint, on_flush=self.flush_children)
+		for field in self.nested:
+			child_table_id = field.staging_table_id if self.incremental and self.incremental.is_incremental else field.table_id
+			self.child_loaders[field.name] = self.make_loader(child_table_id, field.schema, f'{self.endpoint}/{field.name}', max_rows=math.inf, max_bytes=math.inf)
+
+		print(f'{datetime.now()} start upload')
+		return resumed
+
+	# pages are staged as shards in GCS and loaded from there (python_utils/gcs_bucket.py),
+	# or buffered and loaded in as few load jobs as the limits allow
+	def make_loader(self, table_id:str, schema:list, name:str, on_flush=None, max_rows:int=None, max_bytes:int=None):
+		if self.endpoint_info.get('load_format') == 'gcs':
+			gcs_stage = {**DEFAULT_GCS_STAGE, **self.endpoint_info.get('gcs_stage', {})}
+			return GCS_Stage_Loader(
+				bq_client=get_context().bq_client,
+				bucket_client=get_context().storage_client,
+				table_id=table_id,
+				schema=schema,
+				bucket_id=gcs_stage['bucket_id'],
+				prefix=f"{gcs_stage['prefix']}/{name}/{RUN_ID}",
+				trunc_flag=self.trunc_flag,
+				gcs_stage=gcs_stage,
+				on_flush=on_flush,
+				metrics=self.metrics,
+			)
+
+		return BQ_Buffered_Loader(
+			bq_client=get_context().bq_client,
+			table_id=table_id,
+			schema=schema,
+			trunc_flag=self.trunc_flag,
+			max_rows=max_rows or self.endpoint_info.get('load_max_rows', LOAD_MAX_ROWS),
+			max_bytes=max_bytes or self.endpoint_info.get('load_max_bytes', LOAD_MAX_BYTES),
+			autodetect=True,
+			on_flush=on_flush,
+			load_format=self.endpoint_info.get('load_format', 'dataframe'),
+			metrics=self.metrics,
 		)
 
-		params = {'page': cur_page, 'pageSize': page_size}
-		# API request
-		api_response = api_get(access_token, full_api_path, content_type='application/json', params=params)
+	# after every parent load job: load the child rows of the same pages, then record the checkpoint
+	def flush_children(self, offset:int):
+		for child_loader in self.child_loaders.values():
+			child_loader.flush()
+		self.save_checkpoint(offset)
+
+	# rows up to and including the page starting at offset
+	def page_end(self, offset:int, page_size:int) -> int:
+		return min(offset + page_size, self.totalCount)
+
+	# remember the page size of a request when responses are recorded
+	def record_request(self, offset:int, page_size:int):
+		if self.response_cache is not None and not self.replay:
+			self.requested[offset] = page_size
+
+	# store the requests of this run with its cached responses, so the run can be replayed
+	def save_requests(self):
+		if self.response_cache is not None and not self.replay:
+			self.response_cache.save_requests(self.endpoint, dict(self.requested), self.extra_params)
+
+	# record the rows loaded after every load job
+	def save_checkpoint(self, offset:int):
+		save_state(CHECKPOINT_STATE, self.endpoint, {
+			'offset': offset,
+			'total_count': self.totalCount,
+			'table_id': self.load_table_id,
+			'run_id': RUN_ID,
+		})
+
+	# transform stage: modify one page, pages must be transformed in offset order (incremental filtering tracks the newest row)
+	# returns (offset, page size, transformed dataframe, child dataframes) for load_page
+	def transform_page(self, offset:int, page_size:int, page_df:pd.DataFrame) -> tuple:
+		print(Fore.YELLOW + f'Processing {self.page_end(offset, page_size)} out of {self.totalCount}')
+
+		# modify the df
+		with timed(self.metrics, 'transform', offset) as stats:
+			cur_df = mod_endpoints(self.endpoint, page_df)
+
+			# drop rows that have not changed since the watermark
+			if self.incremental:
+				cur_df = self.incremental.filter(cur_df)
+			cur_df, child_dfs = split_nested(cur_df, self.nested)
+			stats['rows'] = len(cur_df)
+
+		return offset, page_size, cur_df, child_dfs
+
+	# load stage: hand one transformed page to the loader, pages must be loaded in offset order
+	def load_page(self, offset:int, page_size:int, cur_df:pd.DataFrame, child_dfs:dict=None):
+		if STOP_EVENT.is_set():
+			raise SystemExit(f'{self.endpoint} interrupted before row {self.offset}')
+
+		rows_done = self.page_end(offset, page_size)
+
+		# loading - buffered, flushed when a row/byte limit is reached
+		# child rows are buffered first, so a parent flush triggered by this page also loads its children
+		if not (self.incremental and self.incremental.is_incremental and cur_df.empty):
+			for name, child_df in (child_dfs or {}).items():
+				if not child_df.empty:
+					self.child_loaders[name].add(child_df, marker=rows_done)
+			self.loader.add(cur_df, marker=rows_done)
+		self.offset = rows_done
+
+		if self.metrics:
+			self.metrics.end_page(offset, page_size=page_size, page=offset // page_size + 1, rows=len(cur_df))
+		print(Fore.CYAN + f'Processed {rows_done} out of {self.totalCount} for {self.endpoint}')
+
+	def add_page(self, offset:int, page_size:int, page_df:pd.DataFrame):
+		self.load_page(*self.transform_page(offset, page_size, page_df))
+
+	# final load, MERGE for incremental endpoints, then drop the checkpoint and remember the page size
+	def finish(self):
+		# load whatever is left in the buffer
+		self.loader.close()
+		for child_loader in self.child_loaders.values():
+			child_loader.close()
+
+		# replace the child rows of changed parents, merge staged changes into the target table and store the new watermark
+		if self.incremental:
+			if self.incremental.is_incremental and self.loader.rows_loaded:
+				replace_children(self.nested, self.incremental, {name: child_loader.rows_loaded for name, child_loader in self.child_loaders.items()})
+			self.incremental.finish(get_context().bq_client, self.loader.rows_loaded)
+		clear_state(CHECKPOINT_STATE, self.endpoint)
+		self.save_requests()
+		# a replay uses the recorded page sizes, the remembered size is left as it is
+		if not self.replay:
+			self.page_sizes.save()
+		print(f'{datetime.now()} stop upload ({self.loader.load_jobs} load job(s))')
+
+	# on failure: load the pages already processed so a resumed run continues after them
+	def abort(self):
+		try:
+			self.save_requests()
+		except Exception as error:
+			print(Fore.RED + f'Unable to record the requests of {self.endpoint} in the response cache\n{error}')
 
-		# read API response
-		# endpoint_object is the data to be extracted from API (list of dicts)
+		if self.loader is None:
+			return
 		try:
-			endpoint_object = api_response[endpoint_info['object']]
+			self.loader.flush()
 		except Exception as error:
-			print(Fore.RED + f"{datetime.now()} Error reading from '{full_api_path}.' Diagnosing...")
-			if 'message' in list(api_response.keys()) and api_response['message'] in "The user is not authorised for this request":
-				print(Fore.RED + f'Insufficient permission\n\n{error}')
-			raise
+			print(Fore.RED + f'Unable to load buffered pages for {self.endpoint} before exiting\n{error}')
 
-		# extract API object (dict) and into dataframe
-		cur_df = pd.DataFrame(endpoint_object)
+# process API endpoints with multiple pages
+# totalCount is read from the first page fetched, the page size is adapted between pages (python_utils/paging.py)
+# fetch, transform and load run as separate stages connected by bounded queues (python_utils/pipeline.py),
+# so pages are fetched while earlier pages are transformed and loaded
+# resume=True continues after the rows of the last checkpoint in append mode if totalCount has not changed
+def multi_page_endpoint(token_provider:Token_Provider, full_api_path:str, endpoint:str, endpoint_info:dict, trunc_flag:bool, resume:bool=False, metrics:Endpoint_Metrics=None):
+	endpoint_load = Endpoint_Load(endpoint, endpoint_info, trunc_flag, resume, metrics=metrics, response_cache=get_api_client().cache)
+	page_sizes = endpoint_load.page_sizes
+
+	# number of pages fetched in parallel, 1 = sequential
+	concurrency = endpoint_info.get('concurrency', 1)
+
+	# fetch the page starting at offset, returns (offset, page size, page dataframe, meta)
+	def fetch(offset:int, page_size:int):
+		page_stats = {}
+		endpoint_load.record_request(offset, page_size)
+		page_df, meta = fetch_page(token_provider, full_api_path, endpoint_info, offset, page_size, endpoint_load.extra_params, metrics, page_stats)
+
+		# a partial (last) page says nothing about the page size, a replay keeps the recorded sizes
+		if len(page_df) == page_size and not endpoint_load.replay:
+			page_sizes.observe(page_size, len(page_df), page_stats['seconds'], page_stats['bytes'])
+		return offset, page_size, page_df, meta
+
+	# fetch stage: (offset, page size, page dataframe) in offset order, starting with the first page
+	def pages(offset:int, page_size:int, page_df:pd.DataFrame):
+		yield offset, page_size, page_df
+		offset = endpoint_load.page_end(offset, page_size)
+
+		if concurrency <= 1:
+			# sequential: every request uses the latest page size
+			while offset < endpoint_load.totalCount:
+				offset, page_size, page_df, _ = fetch(offset, page_sizes.size_at(offset))
+				yield offset, page_size, page_df
+				offset = endpoint_load.page_end(offset, page_size)
+		else:
+			# parallel: the pages of this run share one size, the size learnt from them is used by the next run
+			# fetches run at most one queue ahead of the transform stage, so fetched pages wait in bounded memory
+			requests = page_sizes.pages_from(offset, endpoint_load.totalCount)
+			for offset, page_size, page_df, _ in iter_pages(lambda request: fetch(*request), requests, concurrency, max_ahead=concurrency + PIPELINE_QUEUE_SIZE):
+				yield offset, page_size, page_df
 
-		# modify the df
+	try:
+		# the first page gives totalCount, there is no separate count request
+		offset, page_size, page_df, meta = fetch(endpoint_load.offset, page_sizes.size_at(endpoint_load.offset))
+		if not endpoint_load.start(meta.get('totalCount', 0)):
+			offset, page_size, page_df, meta = fetch(0, page_sizes.size_at(0))
+
+		# at most PIPELINE_QUEUE_SIZE pages wait between two stages, a failing stage stops the others
+		Pipeline(queue_size=PIPELINE_QUEUE_SIZE, name=endpoint).run(
+			source=pages(offset, page_size, page_df),
+			stages=[lambda page: endpoint_load.transform_page(*page)],
+			sink=lambda page: endpoint_load.load_page(*page),
+		)
+	except BaseException:
+		endpoint_load.abort()
+		raise
+
+	endpoint_load.finish()
+
+# process API endpoints with a single page
+# returns 'unchanged' if the payload is the same as at the last load, 'success' otherwise
+def single_page_endpoint(token_provider:Token_Provider, full_api_path:str, endpoint:str, endpoint_info:dict, trunc_flag:bool, metrics:Endpoint_Metrics=None, force:bool=False) -> str:
+	# API request
+	with timed(metrics, 'fetch') as stats:
+		content = api_get_raw(token_provider, full_api_path, content_type='application/json', stats=stats)
+	with timed(metrics, 'decode') as stats:
+		api_response = get_api_client().decode(content)
+		stats['bytes'] = len(content)
+	return load_single_page(full_api_path, endpoint, endpoint_info, api_response, trunc_flag, metrics, force, replay=bool(get_api_client().cache and get_api_client().cache.replay))
+
+# incremental runs: children of the parents in the parent staging table are replaced by the staged child rows
+# a child table whose staging table was not loaded in this run (no child rows) only has those children deleted
+def replace_children(nested:list, incremental:Incremental_Load, child_rows:dict):
+	for field in nested:
+		bq_replace_children(
+			get_context().bq_client,
+			child_staging_table_id=field.staging_table_id,
+			child_table_id=field.table_id,
+			parent_staging_table_id=incremental.staging_table_id,
+			parent_key=field.parent_key,
+			columns=[child_field.name for child_field in field.schema],
+			insert=bool(child_rows.get(field.name)),
+		)
+
+# transform and load the API response of a single-page endpoint
+# the transform and load are skipped if the payload has not changed since the last load, unless force is set
+# replay=True for a replayed response: every row is reloaded and the watermark is left as it is
+def load_single_page(full_api_path:str, endpoint:str, endpoint_info:dict, api_response:dict, trunc_flag:bool, metrics:Endpoint_Metrics=None, force:bool=False, replay:bool=False) -> str:
+	# read API response
+	endpoint_object = read_endpoint_object(full_api_path, endpoint_info, api_response)
+
+	# change detection
+	fingerprint = None
+	if endpoint_info.get('skip_unchanged', True):
+		fingerprint = payload_fingerprint(endpoint_object)
+		if not force and is_unchanged(endpoint, fingerprint, endpoint_info):
+			print(Fore.GREEN + f'{endpoint} is unchanged since the last load, skipping')
+			return 'unchanged'
+
+	# extract API object (dict) and into dataframe
+	cur_df = build_page(endpoint_object, metrics=metrics)
+
+	# incremental endpoints only load rows changed since the last watermark, via a staging table
+	incremental = make_incremental(endpoint, endpoint_info, replay)
+
+	# modify the df
+	with timed(metrics, 'transform') as stats:
 		cur_df = mod_endpoints(endpoint, cur_df)
+		if incremental:
+			cur_df = incremental.filter(cur_df)
+		nested = nested_fields(endpoint_info)
+		cur_df, child_dfs = split_nested(cur_df, nested)
+		stats['rows'] = len(cur_df)
+
+	if incremental:
+		if incremental.is_incremental:
+			trunc_flag = True
+			if cur_df.empty:
+				print(f'No rows updated after {incremental.watermark} for {endpoint}')
+				incremental.finish(get_context().bq_client, 0)
+				if fingerprint:
+					save_fingerprint(endpoint, fingerprint, endpoint_info, RUN_ID)
+				return 'success'
 
-		# loading
-		df_to_bq(
-			bq_client=bq_client,
+	# loading
+	with timed(metrics, 'load_submit') as stats:
+		job = df_to_bq(
+			bq_client=get_context().bq_client,
 			df=cur_df,
-			table_id=endpoint_info['table_id'],
+			table_id=incremental.load_table_id if incremental else endpoint_info['table_id'],
 			mode='t' if trunc_flag else 'a',
-			schema=endpoint_info['schema'],
+			schema=parent_schema(endpoint_info['schema'], nested),
 			autodetect=True,
+			wait=False
 		)
+		stats['rows'] = len(cur_df)
+	with timed(metrics, 'load_wait'):
+		job.result()
 
-		if trunc_flag:
-			trunc_flag = False
+	# child tables, to their staging tables on incremental runs
+	for field in nested:
+		if child_dfs[field.name].empty:
+			continue
+		with timed(metrics, 'load_submit') as stats:
+			job = df_to_bq(
+				bq_client=get_context().bq_client,
+				df=child_dfs[field.name],
+				table_id=field.staging_table_id if incremental and incremental.is_incremental else field.table_id,
+				mode='t' if trunc_flag else 'a',
+				schema=field.schema,
+				autodetect=True,
+				wait=False
+			)
+			stats['rows'] = len(child_dfs[field.name])
+		with timed(metrics, 'load_wait'):
+			job.result()
+
+	# replace the child rows of changed parents, merge staged changes into the target table and store the new watermark
+	if incremental:
+		if incremental.is_incremental:
+			replace_children(nested, incremental, {name: len(child_df) for name, child_df in child_dfs.items()})
+		incremental.finish(get_context().bq_client, len(cur_df))
+
+	if fingerprint:
+		save_fingerprint(endpoint, fingerprint, endpoint_info, RUN_ID)
+	return 'success'
+
+# run one endpoint from start to finish, returns its status ('success' or 'unchanged')
+# metrics_log receives a record per page and a summary of the endpoint
+# force=True loads single-page endpoints even if their payload has not changed
+def run_endpoint(token_provider:Token_Provider, endpoint:str, endpoint_info:dict, resume:bool=False, metrics_log:Metrics_Log=None, force:bool=False) -> str:
+	# construct full API path
+	full_api_path = f"{get_context().api_base_url}/{endpoint_info['url']}"
+	metrics = Endpoint_Metrics(endpoint, RUN_ID, metrics_log)
+
+	print(Fore.BLUE + f'{datetime.now()} Current endpoint:', endpoint)
 
-		print(
-			Fore.CYAN
-			+ f'Processed {(cur_page * page_size) if (cur_page * page_size) < totalCount else totalCount} out of {totalCount} for {endpoint}'
-		)
+	try:
+		trunc_flag = True
+		status = 'success'
+		if endpoint_info['pages'] == 'multi-page':
+			multi_page_endpoint(token_provider, full_api_path, endpoint, endpoint_info, trunc_flag, resume, metrics)
+		else:
+			status = single_page_endpoint(token_provider, full_api_path, endpoint, endpoint_info, trunc_flag, metrics, force)
+	except BaseException as error:
+		metrics.summary('failed', error)
+		if isinstance(error, Exception):
+			print(Fore.RED + f"Error processing endpoint '{full_api_path}'\n\n{error}")
+		raise
+
+	metrics.summary(status)
+	if status == 'success':
+		print(Fore.GREEN + f'{datetime.now()} Endpoint: {endpoint} loaded successfully')
+	return status
+
+'''
+Async engine (--mode async)
+'''
+
+# fetch pages with many requests in flight and pass them, in page order, through a bounded async queue
+# to the same transform and load steps as the sync engine
+async def async_multi_page_endpoint(client:Async_API_Client, token_provider:Token_Provider, full_api_path:str, endpoint:str, endpoint_info:dict, trunc_flag:bool, resume:bool=False, metrics:Endpoint_Metrics=None):
+	endpoint_load = Endpoint_Load(endpoint, endpoint_info, trunc_flag, resume, metrics=metrics, response_cache=client.cache)
+	page_sizes = endpoint_load.page_sizes
+	page_queue = asyncio.Queue(maxsize=ASYNC_QUEUE_SIZE)
+	load_queue = asyncio.Queue(maxsize=ASYNC_QUEUE_SIZE)
+
+	# transform and load run on the endpoint's own worker threads (one page each at a time), so they can be joined:
+	# cancelling a task does not stop the page its worker thread is transforming or loading
+	workers = ThreadPoolExecutor(max_workers=2, thread_name_prefix=f'{endpoint}-worker')
+
+	def in_worker(func, *args):
+		return asyncio.get_running_loop().run_in_executor(workers, func, *args)
+
+	# fetch the page starting at offset, returns (offset, page size, endpoint object, totalCount)
+	# fetch durations include the time a request waits for a free connection, so they are not used to adapt the page size
+	async def fetch(offset:int, page_size:int):
+		params = {'page': offset // page_size + 1, 'pageSize': page_size, **(endpoint_load.extra_params or {})}
+		endpoint_load.record_request(offset, page_size)
+		with timed(metrics, 'fetch', offset) as stats:
+			content = await async_api_get_raw(token_provider, full_api_path, client, content_type='application/json', params=params, stats=stats)
+		with timed(metrics, 'decode', offset) as stats:
+			api_response = client.decode(content)
+			stats['bytes'] = len(content)
+		return offset, page_size, read_endpoint_object(full_api_path, endpoint_info, api_response), api_response.get('totalCount', 0)
+
+	def transform_page(offset:int, page_size:int, endpoint_object:list):
+		return endpoint_load.transform_page(offset, page_size, build_page(endpoint_object, offset, metrics))
+
+	# keep up to max_in_flight page requests running ahead of the page being queued
+	# every page uses the page size remembered from earlier sync runs
+	# a failed fetch ends the page stream instead of cancelling the other tasks: the pages queued before it are
+	# still transformed and loaded, so abort() flushes them and a resumed run continues after them
+	fetch_errors = []
+
+	async def produce(offset:int):
+		requests = page_sizes.pages_from(offset, endpoint_load.totalCount)
+		in_flight = deque()
+		try:
+			for request in itertools.islice(requests, client.max_in_flight):
+				in_flight.append(asyncio.create_task(fetch(*request)))
 
-		# break loop if current iteration already covers all rows
-		if cur_page * page_size >= totalCount:
-			break
-		cur_page += 1
-	print(f'{datetime.now()} stop upload')
+			while in_flight:
+				page_offset, page_size, endpoint_object, _ = await in_flight.popleft()
 
-# process API endpoints with a single page
-def single_page_endpoint(access_token:str, full_api_path:str, endpoint:str, endpoint_info:dict, trunc_flag:bool):
-	# API request
-	api_response = api_get(access_token, full_api_path, content_type='application/json')
+				next_request = next(requests, None)
+				if next_request is not None:
+					in_flight.append(asyncio.create_task(fetch(*next_request)))
+
+				await page_queue.put((page_offset, page_size, endpoint_object))
+		except Exception as error:
+			fetch_errors.append(error)
+		finally:
+			for task in in_flight:
+				task.cancel()
+		await page_queue.put(None)
+
+	# transform and load run in worker threads so the event loop keeps fetching, and loading overlaps transforming
+	async def transform():
+		while (item := await page_queue.get()) is not None:
+			await load_queue.put(await in_worker(transform_page, *item))
+		await load_queue.put(None)
+
+	async def load():
+		while (item := await load_queue.get()) is not None:
+			await in_worker(endpoint_load.load_page, *item)
 
-	# read API response
 	try:
-		endpoint_object = api_response[endpoint_info['object']]
-	except Exception as error:
-		print(Fore.RED + f"{datetime.now()} Error reading from '{full_api_path}.' Diagnosing...")
-		if 'message' in list(api_response.keys()) and api_response['message'] in "The user is not authorised for this request":
-			print(Fore.RED + f'Insufficient permission\n\n{error}')
+		# the first page gives totalCount, there is no separate count request
+		offset, page_size, endpoint_object, totalCount = await fetch(endpoint_load.offset, page_sizes.size_at(endpoint_load.offset))
+		if not await in_worker(endpoint_load.start, totalCount):
+			offset, page_size, endpoint_object, _ = await fetch(0, page_sizes.size_at(0))
+		await page_queue.put((offset, page_size, endpoint_object))
+
+		# a failure in the transform or load task cancels the others
+		try:
+			async with asyncio.TaskGroup() as task_group:
+				task_group.create_task(produce(endpoint_load.page_end(offset, page_size)))
+				task_group.create_task(transform())
+				task_group.create_task(load())
+		except BaseExceptionGroup as group:
+			raise first_error(group) from None
+
+		if fetch_errors:
+			raise fetch_errors[0]
+	except BaseException:
+		# wait for the page being transformed or loaded, the loader must not be flushed while a worker can still add to it
+		await asyncio.to_thread(workers.shutdown, wait=True, cancel_futures=True)
+		await asyncio.to_thread(endpoint_load.abort)
 		raise
 
-	# extract API object (dict) and into dataframe
-	cur_df = pd.DataFrame(endpoint_object)
-	# modify the df
-	cur_df = mod_endpoints(endpoint, cur_df)
+	try:
+		await in_worker(endpoint_load.finish)
+	finally:
+		await asyncio.to_thread(workers.shutdown, wait=True)
+
+# first error of a task group that is not a cancellation, so the async engine reports failures like the sync engine
+def first_error(group:BaseExceptionGroup) -> BaseException:
+	for error in group.exceptions:
+		if isinstance(error, BaseExceptionGroup):
+			error = first_error(error)
+		if not isinstance(error, (asyncio.CancelledError, BaseExceptionGroup)):
+			return error
+	return group
+
+async def async_single_page_endpoint(client:Async_API_Client, token_provider:Token_Provider, full_api_path:str, endpoint:str, endpoint_info:dict, trunc_flag:bool, metrics:Endpoint_Metrics=None, force:bool=False) -> str:
+	with timed(metrics, 'fetch') as stats:
+		content = await async_api_get_raw(token_provider, full_api_path, client, content_type='application/json', stats=stats)
+	with timed(metrics, 'decode') as stats:
+		api_response = client.decode(content)
+		stats['bytes'] = len(content)
+	return await asyncio.to_thread(load_single_page, full_api_path, endpoint, endpoint_info, api_response, trunc_flag, metrics, force, bool(client.cache and client.cache.replay))
+
+async def async_run_endpoint(client:Async_API_Client, token_provider:Token_Provider, endpoint:str, endpoint_info:dict, resume:bool=False, metrics_log:Metrics_Log=None, force:bool=False) -> str:
+	# construct full API path
+	full_api_path = f"{get_context().api_base_url}/{endpoint_info['url']}"
+	metrics = Endpoint_Metrics(endpoint, RUN_ID, metrics_log)
+
+	print(Fore.BLUE + f'{datetime.now()} Current endpoint:', endpoint)
 
-	# loading
-	df_to_bq(
-		bq_client=bq_client,
-		df=cur_df,
-		table_id=endpoint_info['table_id'],
-		mode='t' if trunc_flag else 'a',
-		schema=endpoint_info['schema'],
-		autodetect=True
-	)
+	try:
+		trunc_flag = True
+		status = 'success'
+		if endpoint_info['pages'] == 'multi-page':
+			await async_multi_page_endpoint(client, token_provider, full_api_path, endpoint, endpoint_info, trunc_flag, resume, metrics)
+		else:
+			status = await async_single_page_endpoint(client, token_provider, full_api_path, endpoint, endpoint_info, trunc_flag, metrics, force)
+	except BaseException as error:
+		metrics.summary('failed', error)
+		if isinstance(error, Exception):
+			print(Fore.RED + f"Error processing endpoint '{full_api_path}'\n\n{error}")
+		raise
 
+	metrics.summary(status)
+	if status == 'success':
+		print(Fore.GREEN + f'{datetime.now()} Endpoint: {endpoint} loaded successfully')
+	return status
+
+# async counterpart of run_scheduled: all endpoints share one event loop and one small connection pool
+# jobs is a list of (name, priority, endpoint_info), results match run_scheduled
+async def async_run_endpoints(jobs:list, token_provider:Token_Provider, response_cache=None, resume:bool=False, metrics_log:Metrics_Log=None, force:bool=False) -> dict:
+	ordered = sorted(jobs, key=lambda job: job[1], reverse=True)
+	endpoint_slots = asyncio.Semaphore(MAX_CONCURRENT_ENDPOINTS)
+
+	async def run_job(client:Async_API_Client, endpoint:str, endpoint_info:dict) -> dict:
+		# semaphore waiters are served in order, so higher priority endpoints start first
+		async with endpoint_slots:
+			start = datetime.now()
+			start_time = time.perf_counter()
+			try:
+				status = await async_run_endpoint(client, token_provider, endpoint, endpoint_info, resume, metrics_log, force)
+				error = None
+			except Exception as job_error:
+				status, error = 'failed', job_error
+			return {'status': status, 'error': error, 'start': start, 'duration': time.perf_counter() - start_time}
+
+	async with Async_API_Client(
+		max_connections=ASYNC_MAX_CONNECTIONS,
+		max_in_flight=ASYNC_MAX_IN_FLIGHT,
+		timeout=API_TIMEOUT,
+		headers=API_HEADERS,
+		cache=response_cache,
+	) as client:
+		results = await asyncio.gather(*(run_job(client, endpoint, endpoint_info) for endpoint, _, endpoint_info in ordered))
+
+	return {endpoint: result for (endpoint, _, _), result in zip(ordered, results)}
+
+# default scheduling priority: multi-page endpoints are the largest, start them first
+def endpoint_priority(endpoint_info:dict) -> int:
+	return endpoint_info.get('priority', 10 if endpoint_info['pages'] == 'multi-page' else 0)
+
+# print the outcome of every endpoint in the run
+def print_run_summary(results:dict):
+	print(Style.BRIGHT + f'{datetime.now()} Run summary:')
+	for endpoint, result in results.items():
+		colour = {'success': Fore.GREEN, 'unchanged': Fore.CYAN}.get(result['status'], Fore.RED)
+		line = f"  {endpoint}: {result['status']} in {result['duration']:.1f}s"
+		if result['error'] is not None:
+			line += f" ({type(result['error']).__name__}: {result['error']})"
+		print(colour + line)
+
+# command line options
+def parse_args(argv:list=None):
+	parser = argparse.ArgumentParser(description='Load iSAMS API endpoints to BigQuery')
+	parser.add_argument('--mode', choices=['sync', 'async'], default='sync', help='extraction engine: threads and blocking requests (sync) or asyncio (async)')
+	parser.add_argument('--resume', action='store_true', help='continue multi-page endpoints from their last checkpoint')
+	parser.add_argument('--cache', action='store_true', help='record raw API responses to the response cache')
+	parser.add_argument('--replay', metavar='RUN_ID', help='re-transform and reload the responses cached by run RUN_ID without calling the API')
+	parser.add_argument('--force', action='store_true', help='load single-page endpoints even if their payload has not changed since the last load')
+	parser.add_argument('--endpoints', nargs='+', metavar='ENDPOINT', choices=list(isams_dataset_endpoints), help='run only these endpoints instead of the selection in main(), custom pipelines are skipped')
+	parser.add_argument('--dry-run', action='store_true', help='print the endpoints that would run and exit, without credentials or API calls')
+	return parser.parse_args(argv)
+
+# stop on SIGTERM: running endpoints flush their buffered pages and keep their checkpoint for --resume
+def handle_sigterm(signum, frame):
+	STOP_EVENT.set()
+	raise SystemExit(f'Received signal {signum}')
+
+# print what a run would do, from the configuration and local state only
+def print_run_plan(jobs:list):
+	print(Style.BRIGHT + f'{datetime.now()} Dry run, {len(jobs)} endpoint(s) would run:')
+	for endpoint, priority, endpoint_info in sorted(jobs, key=lambda job: job[1], reverse=True):
+		line = f"  {endpoint}: {endpoint_info['pages']}, priority {priority} -> {endpoint_info['table_id']}"
+		if endpoint_info.get('incremental'):
+			watermark = load_state(WATERMARK_STATE, endpoint)
+			line += f", incremental after {watermark['watermark']}" if watermark else ', full load (no watermark yet)'
+		if endpoint_info['pages'] == 'multi-page':
+			line += f', page size {Adaptive_Page_Size(endpoint, endpoint_info.get("paging")).page_size}'
+		for field in nested_fields(endpoint_info):
+			line += f'\n    {field.name} -> {field.table_id}'
+		print(line)
 
 # main process
-def main():
-	# generate access token
-	access_token = gen_access_token(TOKEN_URL, CLIENT_ID, CLIENT_SECRET, API_BASE_URL)
-	
-	for endpoint, endpoint_info in isams_dataset_endpoints.items():
-		# construct full API path
-		full_api_path = f"{API_BASE_URL}/{endpoint_info['url']}"
+def main(args=None):
+	args = args or parse_args([])
 
-		# selectively run endpoints:
-		if endpoint not in []:
+	jobs = []
+	for endpoint, endpoint_info in isams_dataset_endpoints.items():
+		# selectively run endpoints: --endpoints, or the list below
+		if endpoint not in (args.endpoints or []):
 			continue
 
-		print(Fore.BLUE + f'{datetime.now()} Current endpoint:', endpoint)
+		jobs.append((endpoint, endpoint_priority(endpoint_info), endpoint_info))
 
-		try:
-			trunc_flag = True
-			if endpoint_info['pages'] == 'multi-page':
-				multi_page_endpoint(access_token, full_api_path, endpoint, endpoint_info, trunc_flag)
-			else:
-				single_page_endpoint(access_token, full_api_path, endpoint, endpoint_info, trunc_flag)
-		except Exception as error:
-			print(Fore.RED + f"Error processing endpoint '{full_api_path}'\n\n{error}")
-			raise
+	if args.dry_run:
+		print_run_plan(jobs)
+		return
 
-		print(Fore.GREEN + f'{datetime.now()} Endpoint: {endpoint} loaded successfully')
+	# credentials, secrets and clients are created on first use
+	context = get_context()
+
+	# optional raw response cache: record this run, or replay an earlier one
+	response_cache = None
+	if args.cache or args.replay:
+		response_cache = Response_Cache(
+			cache_dir=RESPONSE_CACHE_DIR,
+			run_id=args.replay or RUN_ID,
+			max_bytes=RESPONSE_CACHE_MAX_BYTES,
+			max_age=RESPONSE_CACHE_MAX_AGE,
+			replay=bool(args.replay),
+		)
+		print(Fore.BLUE + f"{'Replaying' if args.replay else 'Caching'} API responses of run {response_cache.run_id}")
+
+	# set up the pooled HTTP session reused by all endpoints and custom pipelines
+	configure_api_client(pool_size=API_POOL_SIZE, timeout=API_TIMEOUT, headers=API_HEADERS, cache=response_cache)
+
+	# shared access token, cached with its expiry and refreshed when needed
+	token_provider = context.token_provider
+
+	# per-stage metrics of every endpoint, as JSON lines
+	metrics_log = Metrics_Log(METRICS_PATH)
+
+	# a replay is meant to reload, so unchanged payloads are not skipped
+	force = args.force or bool(args.replay)
+
+	# independent endpoints run concurrently, largest (highest priority) first
+	if args.mode == 'async':
+		results = asyncio.run(async_run_endpoints(jobs, token_provider, response_cache, args.resume, metrics_log, force))
+	else:
+		results = run_scheduled(
+			[(endpoint, priority, functools.partial(run_endpoint, token_provider, endpoint, endpoint_info, args.resume, metrics_log, force)) for endpoint, priority, endpoint_info in jobs],
+			max_workers=MAX_CONCURRENT_ENDPOINTS
+		)
+	print_run_summary(results)
+
+	failed = [endpoint for endpoint, result in results.items() if result['status'] == 'failed']
+	if failed:
+		raise RuntimeError(f'{len(failed)} endpoint(s) failed: {", ".join(failed)}')
 
 if __name__ == '__main__':
-	main()
-	custom_pipelines()
+	# line buffering, so logs appear in the log file immediately during execution
+	sys.stdout.reconfigure(line_buffering=True)
+	sys.stderr.reconfigure(line_buffering=True)
+
+	signal.signal(signal.SIGTERM, handle_sigterm)
+	args = parse_args()
+	main(args)
+	if not (args.dry_run or args.endpoints):
+		custom_pipelines()
@@ -0,0 +1,119 @@
+import time
+import asyncio
+from python_utils.json import Token_Provider, json_loads
+
+# aiohttp is only needed for the async engine (--mode async), it is imported by the first Async_API_Client
+aiohttp = None
+
+def _import_aiohttp():
+	global aiohttp
+	if aiohttp is None:
+		try:
+			import aiohttp as aiohttp_module
+		except ImportError:
+			raise ImportError('aiohttp is required for the async engine')
+		aiohttp = aiohttp_module
+
+'''
+Async HTTP client
+'''
+
+# one aiohttp session with a small connection pool shared by every request in the run
+# max_in_flight bounds the number of requests awaiting a response or a free connection
+class Async_API_Client:
+	def __init__(self, max_connections:int=4, max_in_flight:int=200, timeout:tuple=(10, 120), headers:dict=None, cache=None):
+		_import_aiohttp()
+
+		self.max_connections = max_connections
+		self.max_in_flight = max_in_flight
+		self.timeout = timeout
+		self.headers = {
+			'Accept': 'application/json',
+			'Accept-Encoding': 'gzip, deflate',
+			**(headers or {}),
+		}
+		self.cache = cache
+		self.session = None
+		self.semaphore = None
+
+	# the session and semaphore must be created inside the running event loop
+	async def open(self):
+		if self.session is None:
+			connect_timeout, read_timeout = self.timeout
+			self.session = aiohttp.ClientSession(
+				connector=aiohttp.TCPConnector(limit=self.max_connections),
+				timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout),
+				headers=self.headers,
+			)
+			self.semaphore = asyncio.Semaphore(self.max_in_flight)
+		return self
+
+	async def close(self):
+		if self.session is not None:
+			await self.session.close()
+			self.session = None
+
+	async def __aenter__(self):
+		return await self.open()
+
+	async def __aexit__(self, *exc_info):
+		await self.close()
+
+	# GET a url and return (status code, raw body)
+	async def get(self, api_url:str, headers:dict=None, params:dict=None) -> tuple:
+		async with self.semaphore:
+			async with self.session.get(api_url, headers=headers, params=params) as api_response:
+				return api_response.status, await api_response.read()
+
+	def decode(self, content) -> dict:
+		return json_loads(content)
+
+'''
+iSAMS API
+'''
+
+# async counterpart of api_get_raw: raw payload of a GET request, with the same token refresh, response cache and stats handling
+async def async_api_get_raw(access_token:str|Token_Provider, api_url:str, client:Async_API_Client, content_type:str=None, params:dict=None, stats:dict=None) -> bytes:
+	stats = {} if stats is None else stats
+	cache = client.cache
+	if cache is not None and cache.replay:
+		content = cache.get(api_url, params)
+		if content is None:
+			raise LookupError(f"'{api_url}' with params {params} is not cached for run {cache.run_id}")
+		stats['bytes'] = stats.get('bytes', 0) + len(content)
+		return content
+
+	token_provider = access_token if isinstance(access_token, Token_Provider) else None
+	attempts = 2 if token_provider else 1
+	for attempt in range(attempts):
+		# the provider only calls the token endpoint when its token is missing or about to expire
+		token_start = time.perf_counter()
+		token = await asyncio.to_thread(token_provider.get_token) if token_provider else access_token
+		stats['token_seconds'] = stats.get('token_seconds', 0.0) + time.perf_counter() - token_start
+		headers = {
+			'Authorization': f'Bearer {token}'
+		}
+
+		if content_type:
+			headers['Content-Type'] = content_type
+
+		try:
+			status, content = await client.get(api_url, headers=headers, params=params)
+		except Exception as error:
+			print(f"Failed to reach '{api_url}'\n{error}")
+			raise
+
+		if status == 401 and attempt < attempts - 1:
+			print(f"Access token rejected by '{api_url}', refreshing token and retrying")
+			token_provider.invalidate(token)
+			stats['retries'] = stats.get('retries', 0) + 1
+			continue
+		break
+
+	stats['bytes'] = stats.get('bytes', 0) + len(content)
+	if cache is not None and status == 200:
+		cache.put(api_url, params, content)
+	return content
+
+async def async_api_get(access_token:str|Token_Provider, api_url:str, client:Async_API_Client, content_type:str=None, params:dict=None, stats:dict=None):
+	return client.decode(await async_api_get_raw(access_token, api_url, client, content_type, params, stats))
@@ -1,3 +1,17 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from python_utils.formats import content_data
+from python_utils.gcs_bucket import file_hashes, Local_Bucket_Client
+
+# parallel uploads of large files (XML multipart upload), from google-cloud-storage 2.10
+try:
+	from google.cloud.storage import transfer_manager
+except ImportError:
+	transfer_manager = None
+
+OS = os.name
+
 def csv_to_bucket(bucket_client, bucket_id:str, bucket_filepath:str, csv_file_path:str, mode:str, log=False) -> None:
 	if mode not in ('i', 't'):
 		raise ValueError("Incorrect write mode. Must be 'i' for ignore, or 't' for truncate.")
@@ -71,3 +85,107 @@ def excel_to_bucket(bucket_client, bucket_id:str, bucket_filepath:str, excel_fil
 	except Exception:
 		print(f"Failed to upload {excel_file_path} to {bucket_filepath if bucket_filepath else '/'}") if log else ''
 		raise
+
+
+'''
+Bulk sync
+'''
+
+# parallel file uploads in sync_to_bucket
+SYNC_WORKERS = 8
+
+# files from this size are uploaded in parallel chunks
+PARALLEL_UPLOAD_THRESHOLD = 128 * 1024 * 1024
+PARALLEL_UPLOAD_CHUNK_SIZE = 32 * 1024 * 1024
+PARALLEL_UPLOAD_WORKERS = 8
+
+# local files to sync: every file under a directory (object names keep the relative path), or a list of files (object names are the file names)
+def _sync_sources(source) -> list:
+	if isinstance(source, str):
+		if not os.path.isdir(source):
+			raise ValueError(f'{source} is not a directory')
+		sources = []
+		for dir_path, _, file_names in os.walk(source):
+			for file_name in file_names:
+				file_path = os.path.join(dir_path, file_name)
+				sources.append((file_path, os.path.relpath(file_path, source).replace(os.sep, '/')))
+		return sorted(sources, key=lambda item: item[1])
+
+	sources = []
+	for file_path in source:
+		if not os.path.isfile(file_path):
+			raise ValueError(f'{file_path} is not a file')
+		sources.append((file_path, os.path.basename(file_path)))
+	return sources
+
+# upload a directory or a list of files to bucket_filepath, skipping files that are already there unchanged
+# the destination prefix is listed once, and each local file is compared with its object by size and CRC32C (MD5 if
+# google-crc32c is missing or the object has no CRC32C), so unchanged files cost no request
+# changed and new files are hashed and uploaded on max_workers threads, files of at least PARALLEL_UPLOAD_THRESHOLD
+# bytes in parallel chunks
+# returns {uploaded, skipped, failed, bytes_sent, bytes_skipped, seconds, files: [{path, name, action, bytes, error}]}
+def sync_to_bucket(bucket_client, bucket_id:str, bucket_filepath:str, source, max_workers:int=SYNC_WORKERS, log=False) -> dict:
+	start_time = time.perf_counter()
+	sources = _sync_sources(source)
+	prefix = f"{bucket_filepath.strip('/')}/" if bucket_filepath else ''
+
+	try:
+		bucket = bucket_client.bucket(bucket_id)
+		remote = {
+			blob.name: blob for blob in bucket_client.list_blobs(
+				bucket_id,
+				prefix=prefix or None,
+				fields='items(name,size,crc32c,md5Hash),nextPageToken'
+			)
+		}
+	except Exception:
+		print(f'Failed to list {bucket_id}/{prefix}') if log else ''
+		raise
+
+	def sync_file(file_path:str, relative_name:str) -> dict:
+		name = f'{prefix}{relative_name}'
+		size = os.path.getsize(file_path)
+		result = {'path': file_path, 'name': name, 'action': None, 'bytes': size, 'error': None}
+		try:
+			blob = remote.get(name)
+			if blob is not None and blob.size == size:
+				crc32c, md5_hash = file_hashes(file_path)
+				if (crc32c and blob.crc32c == crc32c) or (blob.md5_hash and blob.md5_hash == md5_hash):
+					result['action'] = 'skipped'
+					return result
+
+			content_type = content_data.get(os.path.splitext(file_path)[1], {}).get('content_type')
+			upload_blob = bucket.blob(name)
+			if size >= PARALLEL_UPLOAD_THRESHOLD and transfer_manager is not None and not isinstance(bucket_client, Local_Bucket_Client):
+				transfer_manager.upload_chunks_concurrently(
+					file_path,
+					upload_blob,
+					content_type=content_type,
+					chunk_size=PARALLEL_UPLOAD_CHUNK_SIZE,
+					worker_type=transfer_manager.THREAD,
+					max_workers=PARALLEL_UPLOAD_WORKERS
+				)
+			else:
+				upload_blob.upload_from_filename(file_path, content_type=content_type)
+			result['action'] = 'uploaded'
+		except Exception as error:
+			result['action'] = 'failed'
+			result['error'] = f'{type(error).__name__}: {error}'
+			print(f'Failed to upload {file_path} to {bucket_id}/{name}\n{error}') if log else ''
+		return result
+
+	with ThreadPoolExecutor(max_workers=max(min(max_workers, len(sources)), 1)) as executor:
+		files = list(executor.map(lambda item: sync_file(*item), sources))
+
+	summary = {
+		'uploaded': sum(1 for file in files if file['action'] == 'uploaded'),
+		'skipped': sum(1 for file in files if file['action'] == 'skipped'),
+		'failed': sum(1 for file in files if file['action'] == 'failed'),
+		'bytes_sent': sum(file['bytes'] for file in files if file['action'] == 'uploaded'),
+		'bytes_skipped': sum(file['bytes'] for file in files if file['action'] == 'skipped'),
+		'seconds': time.perf_counter() - start_time,
+		'files': files,
+	}
+	if log:
+		print(f"Synced {len(files)} file(s) to {bucket_id}/{prefix}: {summary['uploaded']} uploaded ({summary['bytes_sent']} bytes), {summary['skipped']} unchanged ({summary['bytes_skipped']} bytes), {summary['failed']} failed")
+	return summary
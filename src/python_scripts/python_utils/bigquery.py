@@ -1,9 +1,21 @@
+import os
+import tempfile
 import pandas as pd
 from io import BytesIO
 from datetime import datetime
 from google.cloud import bigquery as bq
+from python_utils.metrics import timed
 
-def df_to_bq(bq_client, df:pd.DataFrame, table_id:str, mode:str, schema=None, autodetect:bool=True):
+# pyarrow is needed for the Parquet load path (load_format='parquet')
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
+	pq = None
+
+# wait=False returns the submitted load job without waiting for it to finish
+def df_to_bq(bq_client, df:pd.DataFrame, table_id:str, mode:str, schema=None, autodetect:bool=True, wait:bool=True):
 	if mode == 'a':
 		write_disposition = 'WRITE_APPEND'
 	elif mode == 't':
@@ -14,6 +26,290 @@ def df_to_bq(bq_client, df:pd.DataFrame, table_id:str, mode:str, schema=None, au
 	try:
 		job_config = bq.LoadJobConfig(schema=schema, write_disposition=write_disposition, autodetect=autodetect)
 		job = bq_client.load_table_from_dataframe(df, table_id, job_config=job_config)
+		if wait:
+			job.result()
+		return job
+	except Exception:
+		raise
+
+'''
+Arrow/Parquet staging
+'''
+
+# Arrow type for a BigQuery field
+def bq_field_to_arrow(field):
+	if field.field_type in ('RECORD', 'STRUCT'):
+		arrow_type = pa.struct([pa.field(sub_field.name, bq_field_to_arrow(sub_field)) for sub_field in field.fields])
+	else:
+		arrow_types = {
+			'STRING': pa.string(),
+			'INTEGER': pa.int64(),
+			'INT64': pa.int64(),
+			'FLOAT': pa.float64(),
+			'FLOAT64': pa.float64(),
+			'NUMERIC': pa.decimal128(38, 9),
+			'BOOLEAN': pa.bool_(),
+			'BOOL': pa.bool_(),
+			'DATE': pa.date32(),
+			'DATETIME': pa.timestamp('us'),
+			'TIMESTAMP': pa.timestamp('us', tz='UTC'),
+			'BYTES': pa.binary(),
+		}
+		arrow_type = arrow_types[field.field_type]
+
+	if field.mode == 'REPEATED':
+		return pa.list_(arrow_type)
+	return arrow_type
+
+def bq_schema_to_arrow(schema:list):
+	return pa.schema([pa.field(field.name, bq_field_to_arrow(field)) for field in schema])
+
+# DATE/DATETIME columns hold tz-aware local datetimes after transform_df, keep their wall time
+def _arrow_ready(col:pd.Series, field) -> pd.Series:
+	if field.field_type in ('DATETIME', 'DATE') and isinstance(col.dtype, pd.DatetimeTZDtype):
+		col = col.dt.tz_localize(None)
+	if field.field_type == 'DATE' and pd.api.types.is_datetime64_any_dtype(col.dtype):
+		col = col.dt.normalize()
+	return col
+
+# build an Arrow table typed by the BigQuery schema, columns not in the schema are dropped
+# type errors are raised here, before anything is uploaded
+def df_to_arrow(df:pd.DataFrame, schema:list):
+	arrow_schema = bq_schema_to_arrow(schema)
+
+	arrays = []
+	for field, arrow_field in zip(schema, arrow_schema):
+		if field.name not in df.columns:
+			arrays.append(pa.nulls(len(df), type=arrow_field.type))
+			continue
+
+		col = _arrow_ready(df[field.name], field)
+		try:
+			if field.field_type == 'DATE' and pd.api.types.is_datetime64_any_dtype(col.dtype):
+				arrays.append(pa.array(col, from_pandas=True).cast(pa.date32()))
+			else:
+				arrays.append(pa.array(col, type=arrow_field.type, from_pandas=True))
+		except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, ValueError) as error:
+			raise ValueError(f"Column '{field.name}' does not match BigQuery type {field.field_type} ({field.mode}): {error}") from error
+
+	return pa.Table.from_arrays(arrays, schema=arrow_schema)
+
+# streams DataFrames into a local Parquet file, one row group per DataFrame
+class Parquet_Stage:
+	def __init__(self, schema:list, compression:str='zstd', stage_dir:str=None):
+		if pq is None:
+			raise ImportError('pyarrow is required for Parquet staging')
+
+		self.schema = schema
+		file = tempfile.NamedTemporaryFile(suffix='.parquet', dir=stage_dir, delete=False)
+		file.close()
+		self.path = file.name
+		self.writer = pq.ParquetWriter(self.path, bq_schema_to_arrow(schema), compression=compression)
+		self.rows = 0
+		self.bytes = 0
+
+	def write(self, df:pd.DataFrame):
+		table = df_to_arrow(df, self.schema)
+		self.writer.write_table(table)
+		self.rows += table.num_rows
+		self.bytes += table.nbytes
+
+	def close(self):
+		if self.writer is not None:
+			self.writer.close()
+			self.writer = None
+
+	def cleanup(self):
+		self.close()
+		if os.path.isfile(self.path):
+			os.remove(self.path)
+
+# load a local Parquet file to BigQuery
+def parquet_to_bq(bq_client, parquet_path:str, table_id:str, mode:str, schema=None, wait:bool=True):
+	if mode == 'a':
+		write_disposition = 'WRITE_APPEND'
+	elif mode == 't':
+		write_disposition ="WRITE_TRUNCATE"
+	else:
+		raise ValueError(f"{mode} is not recognised. Use 'a' for append or 't' for truncate")
+
+	# list inference maps Parquet LIST columns to REPEATED fields instead of nested records
+	parquet_options = bq.ParquetOptions()
+	parquet_options.enable_list_inference = True
+
+	try:
+		job_config = bq.LoadJobConfig(
+			schema=schema,
+			write_disposition=write_disposition,
+			source_format=bq.SourceFormat.PARQUET,
+			parquet_options=parquet_options,
+		)
+		with open(parquet_path, 'rb') as parquet_file:
+			job = bq_client.load_table_from_file(parquet_file, table_id, job_config=job_config)
+		if wait:
+			job.result()
+		return job
+	except Exception:
+		raise
+
+# default flush thresholds for BQ_Buffered_Loader
+LOAD_MAX_ROWS = 500000
+LOAD_MAX_BYTES = 256 * 1024 * 1024
+
+# collects page DataFrames and loads them to BigQuery in as few load jobs as possible
+# a load job is submitted when max_rows or max_bytes is reached and on close()
+# the first load truncates the table if trunc_flag is set, every later load appends
+# on_flush(marker) is called after each successful load with the marker of the last DataFrame loaded (e.g. its page number)
+# load_format='parquet' streams each DataFrame into a typed local Parquet file and loads that file instead of the DataFrames
+# metrics (optional Endpoint_Metrics) records the load_submit and load_wait stages of every load job
+class BQ_Buffered_Loader:
+	def __init__(self, bq_client, table_id:str, schema=None, trunc_flag:bool=True, max_rows:int=LOAD_MAX_ROWS, max_bytes:int=LOAD_MAX_BYTES, autodetect:bool=True, on_flush=None, load_format:str='dataframe', metrics=None):
+		if load_format not in ('dataframe', 'parquet'):
+			raise ValueError(f"{load_format} is not recognised. Use 'dataframe' or 'parquet'")
+		if load_format == 'parquet' and not schema:
+			raise ValueError('A schema is required for Parquet loads')
+
+		self.bq_client = bq_client
+		self.table_id = table_id
+		self.schema = schema
+		self.trunc_flag = trunc_flag
+		self.max_rows = max_rows
+		self.max_bytes = max_bytes
+		self.autodetect = autodetect
+		self.on_flush = on_flush
+		self.load_format = load_format
+		self.metrics = metrics
+
+		self.load_jobs = 0
+		self.rows_loaded = 0
+		self._frames = []
+		self._rows = 0
+		self._bytes = 0
+		self._marker = None
+		self._stage = None
+
+	# buffer a DataFrame, flushing if a limit is reached
+	def add(self, df:pd.DataFrame, marker=None):
+		self._marker = marker
+		self._rows += len(df)
+
+		if self.load_format == 'parquet':
+			if self._stage is None:
+				self._stage = Parquet_Stage(self.schema)
+			# converting the page to Arrow and writing it to the staged file is part of submitting the load
+			with timed(self.metrics, 'load_submit'):
+				self._stage.write(df)
+			self._bytes = self._stage.bytes
+		else:
+			self._frames.append(df)
+			self._bytes += int(df.memory_usage(deep=True).sum())
+
+		if self._rows >= self.max_rows or self._bytes >= self.max_bytes:
+			return self.flush()
+		return None
+
+	# load everything buffered so far as one load job
+	def flush(self):
+		if self.load_format == 'parquet':
+			if self._stage is None:
+				return None
+
+			# the staged file is kept until it has been loaded, so a failed flush can be retried
+			self._stage.close()
+			with timed(self.metrics, 'load_submit') as stats:
+				stats.update(rows=self._rows, bytes=self._stage.bytes)
+				job = parquet_to_bq(
+					bq_client=self.bq_client,
+					parquet_path=self._stage.path,
+					table_id=self.table_id,
+					mode='t' if self.trunc_flag else 'a',
+					schema=self.schema,
+					wait=False,
+				)
+			with timed(self.metrics, 'load_wait'):
+				job.result()
+			self._stage.cleanup()
+			self._stage = None
+		else:
+			if not self._frames:
+				return None
+
+			df = self._frames[0] if len(self._frames) == 1 else pd.concat(self._frames, ignore_index=True)
+			with timed(self.metrics, 'load_submit') as stats:
+				stats.update(rows=self._rows, bytes=self._bytes)
+				job = df_to_bq(
+					bq_client=self.bq_client,
+					df=df,
+					table_id=self.table_id,
+					mode='t' if self.trunc_flag else 'a',
+					schema=self.schema,
+					autodetect=self.autodetect,
+					wait=False,
+				)
+			with timed(self.metrics, 'load_wait'):
+				job.result()
+
+		self.trunc_flag = False
+		self.load_jobs += 1
+		self.rows_loaded += self._rows
+		self._frames = []
+		self._rows = 0
+		self._bytes = 0
+
+		if self.on_flush:
+			self.on_flush(self._marker)
+		return job
+
+	# final flush at the end of the endpoint
+	def close(self):
+		return self.flush()
+
+# upsert the rows of a staging table into the target table on the primary key
+def bq_merge(bq_client, staging_table_id:str, table_id:str, primary_key:list, columns:list):
+	if not primary_key:
+		raise ValueError('primary_key must contain at least one column')
+
+	on_clause = ' AND '.join(f'T.`{col}` = S.`{col}`' for col in primary_key)
+	update_clause = ', '.join(f'`{col}` = S.`{col}`' for col in columns if col not in primary_key)
+	insert_cols = ', '.join(f'`{col}`' for col in columns)
+	insert_values = ', '.join(f'S.`{col}`' for col in columns)
+
+	query = f"""
+	MERGE `{table_id}` T
+	USING `{staging_table_id}` S
+	ON {on_clause}
+	WHEN MATCHED THEN UPDATE SET {update_clause}
+	WHEN NOT MATCHED THEN INSERT ({insert_cols}) VALUES ({insert_values})
+	"""
+
+	try:
+		job = bq_client.query(query)
+		job.result()
+		return job
+	except Exception:
+		raise
+
+# replace the child rows of the parents in parent_staging_table_id with the rows of child_staging_table_id
+# parent_key maps parent key columns to child key columns, children of changed parents that are no longer listed are deleted
+def bq_replace_children(bq_client, child_staging_table_id:str, child_table_id:str, parent_staging_table_id:str, parent_key:dict, columns:list, insert:bool=True):
+	if not parent_key:
+		raise ValueError('parent_key must contain at least one column')
+
+	match_clause = ' AND '.join(f'C.`{child_col}` = P.`{parent_col}`' for parent_col, child_col in parent_key.items())
+	insert_cols = ', '.join(f'`{col}`' for col in columns)
+
+	query = f"""
+	DELETE FROM `{child_table_id}` C
+	WHERE EXISTS (SELECT 1 FROM `{parent_staging_table_id}` P WHERE {match_clause});
+	"""
+	if insert:
+		query += f"""
+	INSERT INTO `{child_table_id}` ({insert_cols})
+	SELECT {insert_cols} FROM `{child_staging_table_id}`;
+	"""
+
+	try:
+		job = bq_client.query(query)
 		job.result()
 		return job
 	except Exception:
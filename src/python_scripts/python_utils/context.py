@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import threading
+from python_utils.state import STATE_DIR
+
+'''
+Pipeline context
+
+Credentials, secrets and clients shared by iSAMS.py and custom.py. Nothing is read or requested at import time:
+each is created on first use, under a lock, and reused by every endpoint and custom pipeline in the process.
+The Google client libraries are only imported when their client is first needed.
+'''
+
+# Service Account Credentials - override with ISAMS_SERVICE_ACCOUNT_KEY
+KEY_PATH = "Path to folder containing Service Account Keys"
+KEY_NAME = 'Service Account JSON key file'
+SERVICE_ACC_KEY = os.environ.get('ISAMS_SERVICE_ACCOUNT_KEY', f'{KEY_PATH}/{KEY_NAME}')
+
+# Secret Manager secret holding the OAuth2 client credentials (CLIENT_ID, CLIENT_SECRET, TOKEN_URL, API_BASE_URL)
+SECRET_ID = "isams_api_credentials"
+
+# local copy of the secret payload, reused for SECRET_CACHE_TTL seconds - 0 disables the cache
+SECRET_CACHE_TTL = int(os.environ.get('ISAMS_SECRET_CACHE_TTL', 0))
+SECRET_CACHE_DIR = os.path.join(STATE_DIR, 'secrets')
+
+# local directory standing in for GCS (one sub-folder per bucket), e.g. to test the GCS staging load path
+GCS_LOCAL_DIR = os.environ.get('ISAMS_GCS_LOCAL_DIR')
+
+# secret, credentials, bq_client and storage_client can be passed in, e.g. to run against a mock API and a fake BigQuery client
+class Pipeline_Context:
+	def __init__(self, service_account_key:str=SERVICE_ACC_KEY, secret_id:str=SECRET_ID, secret_cache_ttl:int=SECRET_CACHE_TTL, secret_cache_dir:str=SECRET_CACHE_DIR, secret:dict=None, credentials=None, bq_client=None, storage_client=None):
+		self.service_account_key = service_account_key
+		self.secret_id = secret_id
+		self.secret_cache_ttl = secret_cache_ttl
+		self.secret_cache_dir = secret_cache_dir
+
+		self._lock = threading.RLock()
+		self._secret = secret
+		self._credentials = credentials
+		self._bq_client = bq_client
+		self._storage_client = storage_client
+
+	@property
+	def credentials(self):
+		with self._lock:
+			if self._credentials is None:
+				from google.oauth2 import service_account
+				self._credentials = service_account.Credentials.from_service_account_file(self.service_account_key)
+			return self._credentials
+
+	@property
+	def project_id(self) -> str:
+		return self.credentials.project_id
+
+	# BigQuery API client
+	@property
+	def bq_client(self):
+		with self._lock:
+			if self._bq_client is None:
+				from google.cloud import bigquery as bq
+				self._bq_client = bq.Client(credentials=self.credentials, project=self.project_id)
+			return self._bq_client
+
+	# Cloud Storage client, or a local directory client if GCS_LOCAL_DIR is set
+	@property
+	def storage_client(self):
+		with self._lock:
+			if self._storage_client is None:
+				if GCS_LOCAL_DIR:
+					from python_utils.gcs_bucket import Local_Bucket_Client
+					self._storage_client = Local_Bucket_Client(GCS_LOCAL_DIR)
+				else:
+					from google.cloud import storage
+					self._storage_client = storage.Client(credentials=self.credentials, project=self.project_id)
+			return self._storage_client
+
+	# secret payload, from the local cache if it is younger than secret_cache_ttl, from Secret Manager otherwise
+	@property
+	def secret(self) -> dict:
+		with self._lock:
+			if self._secret is None:
+				self._secret = self._read_cached_secret()
+			if self._secret is None:
+				from python_utils.secret_manager import get_secret
+				self._secret = get_secret(self.secret_id, self.project_id, self.credentials)
+				self._write_cached_secret(self._secret)
+			return self._secret
+
+	@property
+	def secret_cache_path(self) -> str:
+		return os.path.join(self.secret_cache_dir, f'{self.secret_id}.json')
+
+	def _read_cached_secret(self):
+		if self.secret_cache_ttl <= 0 or not os.path.isfile(self.secret_cache_path):
+			return None
+		if time.time() - os.path.getmtime(self.secret_cache_path) > self.secret_cache_ttl:
+			return None
+
+		with open(self.secret_cache_path, 'r', encoding='utf-8') as file:
+			return json.load(file)
+
+	# written atomically and readable by the owner only
+	def _write_cached_secret(self, secret:dict):
+		if self.secret_cache_ttl <= 0:
+			return
+		os.makedirs(self.secret_cache_dir, mode=0o700, exist_ok=True)
+
+		tmp_path = f'{self.secret_cache_path}.tmp'
+		with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w', encoding='utf-8') as file:
+			json.dump(secret, file)
+		os.replace(tmp_path, self.secret_cache_path)
+
+	@property
+	def client_id(self) -> str:
+		return self.secret["CLIENT_ID"]
+
+	@property
+	def client_secret(self) -> str:
+		return self.secret["CLIENT_SECRET"]
+
+	@property
+	def token_url(self) -> str:
+		return self.secret["TOKEN_URL"]
+
+	@property
+	def api_base_url(self) -> str:
+		return self.secret["API_BASE_URL"]
+
+	# access token shared by every endpoint and custom pipeline, cached with its expiry
+	@property
+	def token_provider(self):
+		from python_utils.json import get_token_provider
+		return get_token_provider(self.token_url, self.client_id, self.client_secret, self.api_base_url)
+
+_context = None
+_context_lock = threading.Lock()
+
+# the context shared by the process, created on first use
+def get_context() -> Pipeline_Context:
+	global _context
+	with _context_lock:
+		if _context is None:
+			_context = Pipeline_Context()
+		return _context
+
+# replace the shared context, returns the previous one
+def set_context(context:Pipeline_Context) -> Pipeline_Context:
+	global _context
+	with _context_lock:
+		previous, _context = _context, context
+		return previous
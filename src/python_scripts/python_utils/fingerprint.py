@@ -0,0 +1,52 @@
+import hashlib
+from datetime import datetime
+from python_utils.state import load_state, save_state
+
+# use orjson for canonical encoding when it is installed
+try:
+	import orjson
+except ImportError:
+	orjson = None
+	import json
+
+'''
+Change detection
+
+Single-page endpoints that rarely change are only transformed and loaded when their payload has changed since
+the last successful load. The fingerprint is a SHA-256 of the payload encoded with sorted keys, so it does not
+depend on key order or whitespace. It is stored per endpoint with a fingerprint of the schema and the target
+table, and a change to either also triggers a load.
+'''
+
+FINGERPRINT_STATE = 'fingerprints'
+
+# stable hash of a decoded JSON payload
+def payload_fingerprint(payload) -> str:
+	if orjson is not None:
+		encoded = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
+	else:
+		encoded = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+	return hashlib.sha256(encoded).hexdigest()
+
+def schema_fingerprint(schema:list) -> str:
+	return payload_fingerprint([field.to_api_repr() for field in (schema or [])])
+
+# True if the payload, schema and table are the same as at the last successful load
+def is_unchanged(endpoint:str, fingerprint:str, endpoint_info:dict) -> bool:
+	stored = load_state(FINGERPRINT_STATE, endpoint)
+	return bool(stored) and stored == {
+		**stored,
+		'fingerprint': fingerprint,
+		'schema': schema_fingerprint(endpoint_info['schema']),
+		'table_id': endpoint_info['table_id'],
+	}
+
+# store the fingerprint once the payload has been loaded
+def save_fingerprint(endpoint:str, fingerprint:str, endpoint_info:dict, run_id:str=None) -> None:
+	save_state(FINGERPRINT_STATE, endpoint, {
+		'fingerprint': fingerprint,
+		'schema': schema_fingerprint(endpoint_info['schema']),
+		'table_id': endpoint_info['table_id'],
+		'run_id': run_id,
+		'loaded_at': datetime.now(),
+	})
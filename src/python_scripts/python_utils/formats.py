@@ -212,6 +212,11 @@ isams_dataset_endpoints = {
 		'pages': 'multi-page',
 		'table_id':'taylors-data-poc.isams_data.applicants',
 		'schema': applicant_schema,
+		'priority': 10,
+		'incremental': {'watermark_col': 'lastUpdated', 'primary_key': ['personId'], 'filter_param': None},
+		'concurrency': 1,
+		'load_max_rows': 500000,
+		'load_format': 'parquet',
 		'nested_fields': None
 	},
 
@@ -221,6 +226,12 @@ isams_dataset_endpoints = {
 		'pages': 'multi-page',
 		'table_id': 'taylors-data-poc.isams_data.students',
 		'schema': students_schema,
+		'priority': 20,
+		'incremental': {'watermark_col': 'lastUpdated', 'primary_key': ['id'], 'filter_param': None},
+		'concurrency': 1,
+		'stream_decode': True,
+		'load_max_rows': 500000,
+		'load_format': 'parquet',
 	},
 	
 	'alumni': {
@@ -229,6 +240,11 @@ isams_dataset_endpoints = {
 		'pages': 'multi-page',
 		'table_id': 'taylors-data-poc.isams_data.alumni',
 		'schema': alumni_schema,
+		'priority': 30,
+		'incremental': {'watermark_col': 'lastUpdated', 'primary_key': ['personId'], 'filter_param': None},
+		'concurrency': 1,
+		'load_max_rows': 500000,
+		'load_format': 'parquet',
 	},
 	
 	'school_terms': {
@@ -244,7 +260,8 @@ isams_dataset_endpoints = {
 		'object': 'yearGroups',
 		'pages': 'single-page',
 		'table_id': 'taylors-data-poc.isams_data.year_groups',
-		'schema': year_groups_schema
+		'schema': year_groups_schema,
+		'incremental': {'watermark_col': 'lastUpdated', 'primary_key': ['ncYear'], 'filter_param': None},
 	},
 	
 	'billing_cycles' : {
@@ -252,6 +269,7 @@ isams_dataset_endpoints = {
 		'object': 'billingCycles',
 		'pages': 'single-page',
 		'table_id': 'taylors-data-poc.isams_data.billing_cycles',
-		'schema': billing_cycles_schema
+		'schema': billing_cycles_schema,
+		'null_cols': ['endDate'],
 	}
 }
@@ -1,8 +1,23 @@
 import os
+import gzip
+import shutil
+import hashlib
+import base64
 import calendar
+import tempfile
+import pandas as pd
 from typing import Optional, List
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import bigquery as bq
-from file_format import content_data
+from python_utils.formats import content_data
+from python_utils.bigquery import Parquet_Stage
+from python_utils.metrics import timed
+
+# google-crc32c (installed with google-cloud-storage) computes CRC32C checksums in C
+try:
+	import google_crc32c
+except ImportError:
+	google_crc32c = None
 
 OS = os.name
 
@@ -100,6 +115,296 @@ def bucket_excel_to_bq(bq_client, bucket_filepath:str, project_id:str, dataset_i
 		print(f'Failed to load {bucket_filepath} to {project_id}.{dataset_id}.{table_id}. Error: {error}') if log else ''
 		raise
 
+'''
+Checksums
+'''
+
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+
+# (CRC32C, MD5) of a local file in one read, base64-encoded as in GCS object metadata
+# CRC32C is None if google-crc32c is not installed
+def file_hashes(file_path:str) -> tuple:
+	crc32c = google_crc32c.Checksum() if google_crc32c is not None else None
+	md5 = hashlib.md5()
+	with open(file_path, 'rb') as file:
+		for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b''):
+			md5.update(block)
+			if crc32c is not None:
+				crc32c.update(block)
+
+	return (
+		base64.b64encode(crc32c.digest()).decode('ascii') if crc32c is not None else None,
+		base64.b64encode(md5.digest()).decode('ascii'),
+	)
+
+'''
+Local bucket
+
+A local directory standing in for a GCS bucket, e.g. for tests or dry runs of the staging path.
+Implements the storage client calls used in this module: client.bucket(id).blob(name) uploads, and list_blobs.
+Objects are files under <root_dir>/<bucket id>/<object name>.
+'''
+
+class Local_Blob:
+	def __init__(self, bucket, name:str):
+		self.bucket = bucket
+		self.name = name
+		self.path = os.path.join(bucket.path, *name.split('/'))
+
+	@property
+	def size(self) -> int:
+		return os.path.getsize(self.path) if os.path.isfile(self.path) else None
+
+	# base64 MD5 and CRC32C, as GCS reports them
+	@property
+	def md5_hash(self) -> str:
+		return file_hashes(self.path)[1] if os.path.isfile(self.path) else None
+
+	@property
+	def crc32c(self) -> str:
+		return file_hashes(self.path)[0] if os.path.isfile(self.path) else None
+
+	def exists(self) -> bool:
+		return os.path.isfile(self.path)
+
+	def upload_from_filename(self, filename:str, content_type:str=None, **kwargs):
+		os.makedirs(os.path.dirname(self.path), exist_ok=True)
+		tmp_path = f'{self.path}.tmp'
+		shutil.copyfile(filename, tmp_path)
+		os.replace(tmp_path, self.path)
+
+	def download_to_filename(self, filename:str, **kwargs):
+		shutil.copyfile(self.path, filename)
+
+	def delete(self):
+		os.remove(self.path)
+
+class Local_Bucket:
+	def __init__(self, root_dir:str, bucket_id:str):
+		self.name = bucket_id
+		self.path = os.path.join(root_dir, bucket_id)
+
+	def blob(self, name:str) -> Local_Blob:
+		return Local_Blob(self, name)
+
+class Local_Bucket_Client:
+	def __init__(self, root_dir:str):
+		self.root_dir = root_dir
+
+	def bucket(self, bucket_id:str) -> Local_Bucket:
+		return Local_Bucket(self.root_dir, bucket_id)
+
+	def get_bucket(self, bucket_id:str) -> Local_Bucket:
+		return self.bucket(bucket_id)
+
+	# objects under prefix, in name order
+	def list_blobs(self, bucket_or_name, prefix:str=None, **kwargs):
+		bucket = bucket_or_name if isinstance(bucket_or_name, Local_Bucket) else self.bucket(bucket_or_name)
+		names = []
+		for dir_path, _, file_names in os.walk(bucket.path):
+			for file_name in file_names:
+				name = os.path.relpath(os.path.join(dir_path, file_name), bucket.path).replace(os.sep, '/')
+				if not name.endswith('.tmp') and name.startswith(prefix or ''):
+					names.append(name)
+		return [bucket.blob(name) for name in sorted(names)]
+
+'''
+GCS staging load
+
+Large endpoints can be staged in GCS instead of loaded from memory ('load_format': 'gcs'). Page DataFrames are
+written to compressed shards (Parquet, or gzip NDJSON), each shard is uploaded as soon as it is full, on
+upload_workers threads, and the shards of a load are loaded with one load_table_from_uri over a wildcard:
+	gs://<bucket_id>/<prefix>/load-000-*.parquet
+The shards are kept in the bucket as a raw archive of the run.
+
+Endpoints set the bucket and shard options with a 'gcs_stage' entry in isams_dataset_endpoints, e.g.
+	'gcs_stage': {'bucket_id': 'isams-staging', 'prefix': 'isams/raw', 'shard_format': 'parquet'},
+'''
+
+DEFAULT_GCS_STAGE = {
+	'bucket_id': os.environ.get('ISAMS_GCS_STAGE_BUCKET'),
+	'prefix': 'isams',
+	'shard_format': 'parquet', # 'parquet' or 'ndjson'
+	'max_shard_rows': 250000,
+	'max_shard_bytes': 256 * 1024 * 1024, # uncompressed
+	'upload_workers': 4,
+}
+
+SHARD_FORMATS = {
+	'parquet': {'suffix': '.parquet', 'content_type': 'application/vnd.apache.parquet', 'source_format': bq.SourceFormat.PARQUET},
+	'ndjson': {'suffix': '.json.gz', 'content_type': 'application/x-ndjson', 'source_format': bq.SourceFormat.NEWLINE_DELIMITED_JSON},
+}
+
+# DATE/DATETIME columns in the JSON form BigQuery loads: local wall time without an offset
+def _ndjson_ready(df:pd.DataFrame, schema:list) -> pd.DataFrame:
+	columns = {}
+	for field in schema:
+		if field.name not in df.columns:
+			continue
+		col = df[field.name]
+		if field.field_type in ('DATETIME', 'DATE') and pd.api.types.is_datetime64_any_dtype(col.dtype):
+			if isinstance(col.dtype, pd.DatetimeTZDtype):
+				col = col.dt.tz_localize(None)
+			col = col.dt.strftime('%Y-%m-%d' if field.field_type == 'DATE' else '%Y-%m-%dT%H:%M:%S.%f')
+		columns[field.name] = col
+	return pd.DataFrame(columns, index=df.index)
+
+# streams DataFrames into a local gzip-compressed NDJSON file
+class NDJSON_Stage:
+	def __init__(self, schema:list, stage_dir:str=None):
+		self.schema = schema
+		file = tempfile.NamedTemporaryFile(suffix='.json.gz', dir=stage_dir, delete=False)
+		file.close()
+		self.path = file.name
+		self.writer = gzip.open(self.path, 'wt', encoding='utf-8')
+		self.rows = 0
+		self.bytes = 0
+
+	def write(self, df:pd.DataFrame):
+		lines = _ndjson_ready(df, self.schema).to_json(orient='records', lines=True, date_format='iso', force_ascii=False)
+		if lines and not lines.endswith('\n'):
+			lines += '\n'
+		self.writer.write(lines)
+		self.rows += len(df)
+		self.bytes += len(lines)
+
+	def close(self):
+		if self.writer is not None:
+			self.writer.close()
+			self.writer = None
+
+	def cleanup(self):
+		self.close()
+		if os.path.isfile(self.path):
+			os.remove(self.path)
+
+# same interface as BQ_Buffered_Loader (add/flush/close, load_jobs, rows_loaded, on_flush), so Endpoint_Load can use either
+# every flush loads the shards written since the previous one, so a flush on failure followed by a resumed run loads each row once
+class GCS_Stage_Loader:
+	def __init__(self, bq_client, bucket_client, table_id:str, schema:list, bucket_id:str, prefix:str, trunc_flag:bool=True, gcs_stage:dict=None, on_flush=None, metrics=None):
+		config = {**DEFAULT_GCS_STAGE, **(gcs_stage or {})}
+		if not bucket_id:
+			raise ValueError('A bucket is required for GCS staging, set gcs_stage bucket_id or ISAMS_GCS_STAGE_BUCKET')
+		if not schema:
+			raise ValueError('A schema is required for GCS staging')
+		if config['shard_format'] not in SHARD_FORMATS:
+			raise ValueError(f"{config['shard_format']} is not recognised. Use {list(SHARD_FORMATS)}")
+
+		self.bq_client = bq_client
+		self.bucket = bucket_client.bucket(bucket_id)
+		self.table_id = table_id
+		self.schema = schema
+		self.prefix = prefix.strip('/')
+		self.trunc_flag = trunc_flag
+		self.shard_format = SHARD_FORMATS[config['shard_format']]
+		self.max_shard_rows = config['max_shard_rows']
+		self.max_shard_bytes = config['max_shard_bytes']
+		self.on_flush = on_flush
+		self.metrics = metrics
+
+		self.load_jobs = 0
+		self.rows_loaded = 0
+		self.shards_uploaded = 0
+		self._rows = 0
+		self._marker = None
+		self._stage = None
+		self._shards = 0
+		self._uploads = []
+		self._executor = ThreadPoolExecutor(max_workers=config['upload_workers'], thread_name_prefix='gcs-stage')
+		self._max_pending = config['upload_workers'] * 2
+
+	@property
+	def load_prefix(self) -> str:
+		return f'{self.prefix}/load-{self.load_jobs:03d}'
+
+	@property
+	def source_uri(self) -> str:
+		return f"gs://{self.bucket.name}/{self.load_prefix}-*{self.shard_format['suffix']}"
+
+	def _new_stage(self):
+		if self.shard_format['source_format'] == bq.SourceFormat.PARQUET:
+			return Parquet_Stage(self.schema)
+		return NDJSON_Stage(self.schema)
+
+	def _upload(self, stage, name:str):
+		try:
+			self.bucket.blob(name).upload_from_filename(stage.path, content_type=self.shard_format['content_type'])
+		finally:
+			stage.cleanup()
+
+	# close the current shard and upload it in the background
+	# at most 2 x upload_workers shards wait on local disk, further pages wait for an upload to finish
+	def _submit_shard(self):
+		if self._stage is None:
+			return
+		self._stage.close()
+		name = f"{self.load_prefix}-{self._shards:05d}{self.shard_format['suffix']}"
+		self._uploads.append(self._executor.submit(self._upload, self._stage, name))
+		self._stage = None
+		self._shards += 1
+
+		while len([upload for upload in self._uploads if not upload.done()]) > self._max_pending:
+			next(upload for upload in self._uploads if not upload.done()).result()
+
+	def add(self, df:pd.DataFrame, marker=None):
+		self._marker = marker
+		self._rows += len(df)
+
+		if self._stage is None:
+			self._stage = self._new_stage()
+		# encoding the page into the shard is part of submitting the load
+		with timed(self.metrics, 'load_submit'):
+			self._stage.write(df)
+
+		if self._stage.rows >= self.max_shard_rows or self._stage.bytes >= self.max_shard_bytes:
+			self._submit_shard()
+		return None
+
+	# wait for the shard uploads, then load every shard of this load with one load job
+	def flush(self):
+		self._submit_shard()
+		if not self._uploads:
+			return None
+
+		with timed(self.metrics, 'load_submit') as stats:
+			stats.update(rows=self._rows)
+			uploads, self._uploads = self._uploads, []
+			for upload in uploads:
+				upload.result()
+			self.shards_uploaded += len(uploads)
+
+			job_config = bq.LoadJobConfig(
+				schema=self.schema,
+				write_disposition='WRITE_TRUNCATE' if self.trunc_flag else 'WRITE_APPEND',
+				source_format=self.shard_format['source_format'],
+			)
+			if self.shard_format['source_format'] == bq.SourceFormat.PARQUET:
+				# list inference maps Parquet LIST columns to REPEATED fields instead of nested records
+				parquet_options = bq.ParquetOptions()
+				parquet_options.enable_list_inference = True
+				job_config.parquet_options = parquet_options
+
+			job = self.bq_client.load_table_from_uri(self.source_uri, self.table_id, job_config=job_config)
+		with timed(self.metrics, 'load_wait'):
+			job.result()
+
+		self.trunc_flag = False
+		self.load_jobs += 1
+		self.rows_loaded += self._rows
+		self._rows = 0
+		self._shards = 0
+
+		if self.on_flush:
+			self.on_flush(self._marker)
+		return job
+
+	# final flush at the end of the endpoint
+	def close(self):
+		try:
+			return self.flush()
+		finally:
+			self._executor.shutdown(wait=True)
+
 '''
 Expansion:
 - ETL from various databases to data warehouse
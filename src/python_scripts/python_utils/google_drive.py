@@ -1,11 +1,19 @@
 import os
+import time
+import threading
+import httplib2
+import tempfile
 import openpyxl
+import pandas as pd
+import google_auth_httplib2
 from io import BytesIO
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from google.oauth2 import service_account
 from googleapiclient.discovery import build, Resource
 from googleapiclient.http import MediaIoBaseUpload, MediaIoBaseDownload
 from python_utils.formats import content_data
+from python_utils.modify_cols import transform_df, TIMEZONE
 from python_utils.utils import *
 
 '''
@@ -19,13 +27,193 @@ def build_drive_service(service_account_key) -> Resource:
 	service = build('drive', 'v3', credentials=creds)
 	return service
 
+'''
+Folder cache
+'''
+
+# seconds a folder listing is reused before it is listed again - 0 disables the cache
+DRIVE_CACHE_TTL = 300
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# lists the children of a folder once (one paged files().list with a minimal field mask)
+# and answers folder and duplicate file lookups in that folder from memory until the listing expires
+# files created or updated through Google_Drive are written into the listing, so it stays current without listing again
+class Drive_Folder_Cache:
+	def __init__(self, service, is_shared_drive:bool, ttl:float=DRIVE_CACHE_TTL):
+		self.service = service
+		self.is_shared_drive = is_shared_drive
+		self.ttl = ttl
+
+		# parent folder id: (listed at, {file id: file})
+		self.folders = {}
+		self._lock = threading.RLock()
+
+	def _list_children(self, parent_folder_id:str) -> dict:
+		children = {}
+		page_token = None
+		while True:
+			results = self.service.files().list(
+				q=f"'{parent_folder_id}' in parents and trashed=false",
+				fields='nextPageToken, files(id, name, mimeType, modifiedTime)',
+				pageSize=1000,
+				pageToken=page_token,
+				supportsAllDrives=self.is_shared_drive,
+				includeItemsFromAllDrives=self.is_shared_drive
+			).execute()
+
+			for file in results.get('files', []):
+				children[file['id']] = file
+
+			page_token = results.get('nextPageToken')
+			if not page_token:
+				return children
+
+	# children of a folder, listed again once the listing is older than ttl
+	def children(self, parent_folder_id:str) -> dict:
+		with self._lock:
+			listed_at, children = self.folders.get(parent_folder_id, (None, None))
+			if listed_at is None or time.monotonic() - listed_at > self.ttl:
+				children = self._list_children(parent_folder_id)
+				self.folders[parent_folder_id] = (time.monotonic(), children)
+			return children
+
+	# files (or folders only) named file_name in a folder, most recently modified first
+	def find(self, parent_folder_id:str, file_name:str, folders_only:bool=False) -> list:
+		with self._lock:
+			matches = [
+				dict(file) for file in self.children(parent_folder_id).values()
+				if file['name'] == file_name and (not folders_only or file.get('mimeType') == FOLDER_MIME_TYPE)
+			]
+		return sorted(matches, key=lambda file: file.get('modifiedTime', ''), reverse=True)
+
+	# add a created file or folder to its parent's listing - a new folder is known to be empty
+	def add(self, parent_folder_id:str, file:dict):
+		with self._lock:
+			if parent_folder_id in self.folders:
+				self.folders[parent_folder_id][1][file['id']] = file
+			if file.get('mimeType') == FOLDER_MIME_TYPE:
+				self.folders[file['id']] = (time.monotonic(), {})
+
+	# refresh an updated file in every listing that contains it
+	def update(self, file:dict):
+		with self._lock:
+			for _, children in self.folders.values():
+				if file['id'] in children:
+					children[file['id']] = {**children[file['id']], **file}
+
+	# drop the listing of one folder, or of every folder
+	def invalidate(self, parent_folder_id:str=None):
+		with self._lock:
+			if parent_folder_id is None:
+				self.folders.clear()
+			else:
+				self.folders.pop(parent_folder_id, None)
+
+'''
+Uploads
+'''
+
+# parallel media uploads in bulk_to_drive, each worker uses its own HTTP connection
+DRIVE_UPLOAD_WORKERS = 8
+
+# retries of a request on 5xx/429/connection errors, with exponential backoff (googleapiclient num_retries)
+DRIVE_UPLOAD_RETRIES = 5
+
+# Drive accepts at most 100 calls in one batch request
+DRIVE_BATCH_SIZE = 100
+
+# files up to this size are sent in one simple upload request instead of a resumable session
+SIMPLE_UPLOAD_MAX_BYTES = 5 * 1024 * 1024
+
+# resumable chunks are a multiple of 256 KiB, capped so concurrent uploads do not each hold 100 MiB (the default) in memory
+CHUNK_ALIGNMENT = 256 * 1024
+MAX_CHUNK_SIZE = 32 * 1024 * 1024
+
+# media for a file buffer: a simple upload for small files, otherwise a resumable upload in chunks sized to the file
+def drive_media(file_buffer, mime_type:str) -> MediaIoBaseUpload:
+	file_buffer.seek(0, os.SEEK_END)
+	size = file_buffer.tell()
+	file_buffer.seek(0)
+
+	if size <= SIMPLE_UPLOAD_MAX_BYTES:
+		return MediaIoBaseUpload(file_buffer, mimetype=mime_type, resumable=False)
+
+	chunk_size = min(-(-size // CHUNK_ALIGNMENT) * CHUNK_ALIGNMENT, MAX_CHUNK_SIZE)
+	return MediaIoBaseUpload(file_buffer, mimetype=mime_type, chunksize=chunk_size, resumable=True)
+
+'''
+Downloads
+'''
+
+# bytes requested per download chunk
+DOWNLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+
+# downloads are held in memory up to this size, then spill to a temporary file
+DOWNLOAD_SPOOL_MAX_BYTES = 64 * 1024 * 1024
+
+# native Google Sheets cannot be downloaded as they are, they are exported as .xlsx
+SPREADSHEET_MIME_TYPE = 'application/vnd.google-apps.spreadsheet'
+
+'''
+Excel
+'''
+
+# rows per DataFrame returned by excel_to_dfs
+EXCEL_CHUNK_ROWS = 50000
+
+# reads one sheet of a workbook with openpyxl's read-only (streaming) mode and yields DataFrames of chunk_rows rows
+# the first non-empty row is the header, empty rows are skipped
+# with a BigQuery schema (formats.py) the chunks have exactly the schema columns, coerced to the schema types
+def excel_to_dfs(file_buffer, sheet_name:str=None, schema:list=None, chunk_rows:int=EXCEL_CHUNK_ROWS):
+	workbook = openpyxl.load_workbook(file_buffer, read_only=True, data_only=True)
+	try:
+		sheet = workbook[sheet_name] if sheet_name else workbook.active
+		rows = (row for row in sheet.iter_rows(values_only=True) if any(value is not None for value in row))
+
+		header = next(rows, None)
+		if header is None:
+			return
+		columns = [str(name) if name is not None else f'column_{index}' for index, name in enumerate(header)]
+
+		# read-only rows can be shorter than the header (trailing empty cells) or longer (cells without a header)
+		chunk = []
+		for row in rows:
+			chunk.append(row[:len(columns)] + (None,) * (len(columns) - len(row)))
+			if len(chunk) >= chunk_rows:
+				yield excel_chunk_to_df(chunk, columns, schema)
+				chunk = []
+		if chunk:
+			yield excel_chunk_to_df(chunk, columns, schema)
+	finally:
+		workbook.close()
+
+def excel_chunk_to_df(chunk:list, columns:list, schema:list=None) -> pd.DataFrame:
+	df = pd.DataFrame.from_records(chunk, columns=columns)
+	if not schema:
+		return df
+
+	df = df.reindex(columns=[field.name for field in schema])
+	for field in schema:
+		col = df[field.name]
+		if field.field_type in ('DATETIME', 'TIMESTAMP', 'DATE') and col.map(lambda value: isinstance(value, datetime)).any():
+			# Excel dates are wall-clock times without a timezone, they are local to TIMEZONE (not UTC)
+			df[field.name] = pd.to_datetime(col, errors='coerce').dt.tz_localize(TIMEZONE, ambiguous='NaT', nonexistent='NaT')
+		elif field.field_type == 'STRING':
+			# cells typed as numbers in a text column
+			df[field.name] = col.astype('string')
+
+	return transform_df(df, schema)
+
 class Google_Drive:
-	def __init__(self, service, is_shared_drive:str, main_drive_id:str):
+	def __init__(self, service, is_shared_drive:str, main_drive_id:str, cache_ttl:float=DRIVE_CACHE_TTL):
 		if not isinstance(is_shared_drive, bool):
 			raise ValueError('is_shared_drive must be type <bool>')
 		
 		self.service = service
 		self.is_shared_drive = is_shared_drive
+		self.cache = Drive_Folder_Cache(service, is_shared_drive, cache_ttl) if cache_ttl > 0 else None
+		self._local = threading.local()
 		if not is_shared_drive:
 			if main_drive_id == 'my-drive':
 				self.main_drive_id = 'root'
@@ -39,6 +227,14 @@ class Google_Drive:
 	'''
 	# returns a list of duplicate file id and names
 	def drive_get_dup_files(self, dst_folder_id:str, file_name:str, log:bool=False) -> list:
+		if self.cache:
+			try:
+				return [{'id': file['id'], 'name': file['name']} for file in self.cache.find(dst_folder_id, file_name)]
+			except Exception as error:
+				if log:
+					print(f'Unable to read folder Id {dst_folder_id}\n{error}')
+				raise
+
 		query = f"""
 		'{dst_folder_id}' in parents
 		and name='{file_name}'
@@ -64,39 +260,53 @@ class Google_Drive:
 
 	# create/upload a new file in Google Drive
 	# allow duplicates
-	def drive_create_file(self, file_metadata:dict, media, log:bool=False):
+	def drive_create_file(self, file_metadata:dict, media, log:bool=False, http=None, num_retries:int=0) -> dict:
 		if log:
 			print(f"{datetime.now()} Creating {file_metadata['name']}")
 		try:
-			self.service.files().create(
+			file = self.service.files().create(
 				body=file_metadata,
 				media_body=media,
-				fields='id',
+				fields='id, name, mimeType, modifiedTime',
 				supportsAllDrives=self.is_shared_drive
-			).execute()
+			).execute(http=http, num_retries=num_retries)
 		except Exception as error:
+			# the file may or may not exist now, list the folder again next time
+			if self.cache:
+				self.cache.invalidate(file_metadata['parents'][0])
 			if log:
 				print(f"Error processing: {file_metadata['name']}\n{error}")
 			raise
 
+		if self.cache:
+			self.cache.add(file_metadata['parents'][0], file)
+		return file
+
 	# update file in Drive if the file being uploaded alr exists
 	# truncate duplicate files
-	def drive_update_file(self, media, dup_files:list, log:bool=False):
+	def drive_update_file(self, media, dup_files:list, log:bool=False, http=None, num_retries:int=0) -> dict:
 		if log:
 			print(f"{datetime.now()} Updating {dup_files[0]['name']}")
 
 		dup_file_id = dup_files[0]['id']
 		try:
-			self.service.files().update(
+			file = self.service.files().update(
 				fileId=dup_file_id,
 				media_body=media,
+				fields='id, name, mimeType, modifiedTime',
 				supportsAllDrives=self.is_shared_drive
-			).execute()
+			).execute(http=http, num_retries=num_retries)
 		except Exception as error:
+			if self.cache:
+				self.cache.invalidate()
 			if log:
 				print(f"Error processing: {dup_files[0]['name']}\n{error}")
 			raise
 
+		if self.cache:
+			self.cache.update(file)
+		return file
+
 	'''
 	Search/Autodetect
 	'''
@@ -112,22 +322,24 @@ class Google_Drive:
 		"""
 
 		try:
-			# execute the query
-			results = self.service.files().list(
-				q=query,
-				fields='files(id, name, modifiedTime)',
-				orderBy='modifiedTime desc',
-				pageSize=1,
-				supportsAllDrives=self.is_shared_drive,
-				includeItemsFromAllDrives=self.is_shared_drive
-			).execute()
+			if self.cache:
+				folders_in_drive = self.cache.find(parent_folder_id, folder_name, folders_only=True)
+			else:
+				# execute the query
+				results = self.service.files().list(
+					q=query,
+					fields='files(id, name, modifiedTime)',
+					orderBy='modifiedTime desc',
+					pageSize=1,
+					supportsAllDrives=self.is_shared_drive,
+					includeItemsFromAllDrives=self.is_shared_drive
+				).execute()
+				folders_in_drive = results.get('files', []) # files_in_drive = results.get('files', [])
 		except Exception as error:
 			if log:
 				print(f"Unable to autodetect '{folder_name}' in folder Id '{parent_folder_id}\n{error}'")
 			raise
 
-		folders_in_drive = results.get('files', []) # files_in_drive = results.get('files', [])
-
 		if folders_in_drive:
 			return folders_in_drive[0]
 		elif not folders_in_drive and create_folder:
@@ -140,15 +352,19 @@ class Google_Drive:
 			try:
 				folder = self.service.files().create(
 					body=folder_metadata,
-					fields='id, name',
+					fields='id, name, mimeType, modifiedTime',
 					supportsAllDrives=self.is_shared_drive
 					# note that for .create, there is no need to includeItemsFromAllDrives=is_shared_drive
 				).execute()
 			except Exception as error:
+				if self.cache:
+					self.cache.invalidate(parent_folder_id)
 				if log:
 					print(f"Unable to create '{folder_name}' in folder Id '{parent_folder_id}'")
 				raise
 
+			if self.cache:
+				self.cache.add(parent_folder_id, folder)
 			return folder
 
 		return []
@@ -156,6 +372,13 @@ class Google_Drive:
 	# search a file by name in Google Drive
 	# return (file_id, file_name, last_modified)
 	def drive_search_filename(self, parent_folder_id: str, file_name:str) -> list:
+		if self.cache:
+			try:
+				files = self.cache.find(parent_folder_id, file_name)
+			except Exception as error:
+				return []
+			return files[0] if files else []
+
 		query = f"""
 		'{parent_folder_id}' in parents
 		and name = '{file_name}'
@@ -165,7 +388,7 @@ class Google_Drive:
 		try:
 			response = self.service.files().list(
 				q=query,
-				fields='files(id, name, modifiedTime)',
+				fields='files(id, name, mimeType, modifiedTime)',
 				orderBy='modifiedTime desc',
 				pageSize=1,
 				supportsAllDrives=self.is_shared_drive,
@@ -214,11 +437,7 @@ class Google_Drive:
 		# upload process
 		try:
 			with open(file_path, mode) as file:
-				media = MediaIoBaseUpload(
-					file,
-					mimetype=mime_type,
-					resumable=True
-				)
+				media = drive_media(file, mime_type)
 
 				if update_dup:
 					dup_files = self.drive_get_dup_files(dst_folder_id, file_name, log)
@@ -261,11 +480,7 @@ class Google_Drive:
 			raise ValueError('Incorrect tuple')
 
 		# MediaBaseUpload media object
-		media = MediaIoBaseUpload(
-			file_data[1], # file buffer
-			mimetype=content_data[file_data[2]]['content_type'],
-			resumable=True
-		)
+		media = drive_media(file_data[1], content_data[file_data[2]]['content_type'])
 
 		# upload process
 		try:
@@ -280,15 +495,149 @@ class Google_Drive:
 			else:
 				self.drive_create_file(file_metadata, media, log)
 		except Exception as error:
-			print(f'Upload failed for {file_metadata['name']}\n{error}') if log else 0
+			print(f"Upload failed for {file_metadata['name']}\n{error}") if log else 0
 			raise
 
+	# httplib2 connections are not thread-safe, so every upload worker authorizes its own
+	# None (the service's own connection) if the service was built without google-auth credentials
+	def _thread_http(self):
+		if not hasattr(self._local, 'http'):
+			credentials = getattr(getattr(self.service, '_http', None), 'credentials', None)
+			self._local.http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http()) if credentials else None
+		return self._local.http
+
+	# duplicate files for many names in one folder: {file name: [{id, name}, ...]}
+	# answered from the folder cache (one listing), or with the queries grouped into batch requests
+	def drive_get_dup_files_bulk(self, dst_folder_id:str, file_names:list, log:bool=False) -> dict:
+		if self.cache:
+			return {file_name: self.drive_get_dup_files(dst_folder_id, file_name, log) for file_name in file_names}
+
+		dup_files = {}
+		errors = []
+		def callback(request_id, response, exception):
+			if exception is not None:
+				errors.append(exception)
+			else:
+				dup_files[request_id] = response.get('files', [])
+
+		for start in range(0, len(file_names), DRIVE_BATCH_SIZE):
+			batch = self.service.new_batch_http_request(callback=callback)
+			for file_name in file_names[start:start + DRIVE_BATCH_SIZE]:
+				batch.add(self.service.files().list(
+					q=f"'{dst_folder_id}' in parents and name='{file_name}' and trashed=false",
+					fields='files(id, name)',
+					supportsAllDrives=self.is_shared_drive,
+					includeItemsFromAllDrives=self.is_shared_drive
+				), request_id=file_name)
+			batch.execute()
+
+		if errors:
+			if log:
+				print(f'Unable to read folder Id {dst_folder_id}\n{errors[0]}')
+			raise errors[0]
+		return dup_files
+
+	# uploads many files to one folder: local file paths and/or (file name, file buffer, file type) tuples
+	# duplicate checks are done up front for all files, then the media uploads run on max_workers threads
+	# returns one result per file, in input order: {name, id, action, bytes, seconds, error}
+	# a failed file does not stop the others, its result has the error
+	def bulk_to_drive(self, dst_folder_id:str, files:list, update_dup=True, max_workers:int=DRIVE_UPLOAD_WORKERS, num_retries:int=DRIVE_UPLOAD_RETRIES, log=False) -> list:
+		if not isinstance(update_dup, bool):
+			raise ValueError('Update dup must be value type <bool>')
+
+		# (file name, local path or file buffer, file type)
+		uploads = []
+		for file in files:
+			if isinstance(file, str):
+				if not os.path.isfile(file):
+					raise ValueError(f'{file} is not a file')
+				uploads.append((os.path.basename(file), file, os.path.splitext(file)[1]))
+			elif isinstance(file, tuple) and len(file) == 3 and hasattr(file[1], 'seek'):
+				uploads.append(file)
+			else:
+				raise ValueError('files must be file paths or tuples of len = 3, in the form of (file name, file buffer, file type)')
+
+			if uploads[-1][2] not in content_data:
+				raise ValueError(f'Invalid file type. Supported: {list(content_data.keys())}')
+
+		file_names = [upload[0] for upload in uploads]
+		if update_dup and len(set(file_names)) != len(file_names):
+			raise ValueError('File names must be unique when update_dup is True')
+
+		dup_files = self.drive_get_dup_files_bulk(dst_folder_id, file_names, log) if update_dup else {}
+
+		def upload(file_name:str, source, file_type:str) -> dict:
+			result = {'name': file_name, 'id': None, 'action': None, 'bytes': 0, 'seconds': 0.0, 'error': None}
+			start_time = time.perf_counter()
+			file_buffer = open(source, 'rb') if isinstance(source, str) else source
+			try:
+				media = drive_media(file_buffer, content_data[file_type]['content_type'])
+				result['bytes'] = media.size()
+
+				if dup_files.get(file_name):
+					file = self.drive_update_file(media, dup_files[file_name], log, self._thread_http(), num_retries)
+					result['action'] = 'updated'
+				else:
+					file_metadata = {'name': file_name, 'parents': [dst_folder_id], 'driveId': self.main_drive_id}
+					file = self.drive_create_file(file_metadata, media, log, self._thread_http(), num_retries)
+					result['action'] = 'created'
+				result['id'] = file['id']
+			except Exception as error:
+				result['error'] = f'{type(error).__name__}: {error}'
+				print(f'Upload failed for {file_name}\n{error}') if log else 0
+			finally:
+				if isinstance(source, str):
+					file_buffer.close()
+			result['seconds'] = time.perf_counter() - start_time
+			return result
+
+		with ThreadPoolExecutor(max_workers=max(min(max_workers, len(uploads)), 1)) as executor:
+			results = list(executor.map(lambda args: upload(*args), uploads))
+
+		if log:
+			failed = sum(1 for result in results if result['error'])
+			sent = sum(result['bytes'] for result in results if not result['error'])
+			print(f'{datetime.now()} Uploaded {len(results) - failed} of {len(results)} file(s), {sent} bytes, to folder Id {dst_folder_id}')
+		return results
+
 	'''
 	Read/download files
 	'''
 
-	def download_file_from_drive(self, dst_folder_id:str):
-		pass
+	# downloads a file in chunks into a spooled buffer (in memory up to DOWNLOAD_SPOOL_MAX_BYTES, then a temporary file)
+	# export_mime_type exports a native Google file (e.g. a Sheet) to that format instead
+	# returns the buffer at its first byte, the caller closes it
+	def download_file_from_drive(self, file_id:str, export_mime_type:str=None, chunk_size:int=DOWNLOAD_CHUNK_SIZE, log=False):
+		if export_mime_type:
+			request = self.service.files().export_media(fileId=file_id, mimeType=export_mime_type)
+		else:
+			request = self.service.files().get_media(fileId=file_id, supportsAllDrives=self.is_shared_drive)
+
+		file_buffer = tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_MAX_BYTES)
+		try:
+			downloader = MediaIoBaseDownload(file_buffer, request, chunksize=chunk_size)
+			done = False
+			while not done:
+				status, done = downloader.next_chunk(num_retries=DRIVE_UPLOAD_RETRIES)
+				if log and status:
+					print(f'{datetime.now()} Downloaded {int(status.progress() * 100)}% of file Id {file_id}')
+		except Exception as error:
+			file_buffer.close()
+			print(f'Download failed for file Id {file_id}\n{error}') if log else 0
+			raise
 
-	def read_excel_to_df(self, dst_folder_id:str, file_metadata:tuple, log=False):
-		pass
\ No newline at end of file
+		file_buffer.seek(0)
+		return file_buffer
+
+	# reads a workbook (or a native Google Sheet) by name from a Drive folder, yields DataFrames of chunk_rows rows
+	# see excel_to_dfs, e.g. to load a large sheet without holding it in memory:
+	#	for df in drive.read_excel_to_df(folder_id, 'staff.xlsx', schema=staff_schema):
+	#		df_to_bq(bq_client, df, table_id, mode='a')
+	def read_excel_to_df(self, dst_folder_id:str, file_name:str, sheet_name:str=None, schema:list=None, chunk_rows:int=EXCEL_CHUNK_ROWS, log=False):
+		file = self.drive_search_filename(dst_folder_id, file_name)
+		if not file:
+			raise ValueError(f"'{file_name}' not found in folder Id '{dst_folder_id}'")
+
+		export_mime_type = content_data['.xlsx']['content_type'] if file.get('mimeType') == SPREADSHEET_MIME_TYPE else None
+		with self.download_file_from_drive(file['id'], export_mime_type, log=log) as file_buffer:
+			yield from excel_to_dfs(file_buffer, sheet_name, schema, chunk_rows)
\ No newline at end of file
@@ -1,9 +1,91 @@
+import io
+import time
 import requests
+import threading
 from typing import Any
+from requests.adapters import HTTPAdapter
+
+# use orjson for decoding payloads when it is installed, fall back to the stdlib parser otherwise
+try:
+	from orjson import loads as json_loads
+except ImportError:
+	from json import loads as json_loads
+
+# ijson is needed for the streaming decode path (api_get_columns), fall back to a full decode without it
+try:
+	import ijson
+except ImportError:
+	ijson = None
+
+'''
+HTTP client
+'''
+
+# shared HTTP client: one pooled keep-alive session reused by every request in the run
+# cache is an optional Response_Cache: payloads are recorded to it, or read from it in replay mode
+class API_Client:
+	def __init__(self, pool_size:int=10, timeout:tuple=(10, 120), headers:dict=None, cache=None):
+		self.timeout = timeout
+		self.cache = cache
+		self.session = requests.Session()
+
+		# keep up to pool_size connections alive per host
+		adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+		self.session.mount('https://', adapter)
+		self.session.mount('http://', adapter)
+
+		# ask for compressed payloads, requests decompresses them transparently
+		self.session.headers.update({
+			'Accept': 'application/json',
+			'Accept-Encoding': 'gzip, deflate',
+		})
+		if headers:
+			self.session.headers.update(headers)
+
+	def get(self, api_url:str, headers:dict=None, params:dict=None, stream:bool=False) -> requests.Response:
+		return self.session.get(api_url, headers=headers, params=params, timeout=self.timeout, stream=stream)
+
+	def post(self, api_url:str, data:dict=None, headers:dict=None) -> requests.Response:
+		return self.session.post(api_url, data=data, headers=headers, timeout=self.timeout)
+
+	# decode a JSON payload (bytes or str)
+	def decode(self, content) -> Any:
+		return json_loads(content)
+
+	def close(self):
+		self.session.close()
+
+_api_client = None
+
+# set up the shared HTTP client once per run
+# replaces (and closes) any client configured earlier
+def configure_api_client(pool_size:int=10, timeout:tuple=(10, 120), headers:dict=None, cache=None) -> API_Client:
+	global _api_client
+
+	if _api_client is not None:
+		_api_client.close()
+
+	_api_client = API_Client(pool_size=pool_size, timeout=timeout, headers=headers, cache=cache)
+	return _api_client
+
+# return the shared HTTP client, creating one with default settings if none was configured
+def get_api_client() -> API_Client:
+	global _api_client
+
+	if _api_client is None:
+		_api_client = API_Client()
+	return _api_client
+
+'''
+OAuth2 access token
+'''
+
+# request a new token and return the full token payload (access_token, expires_in, ...)
+def request_access_token(token_url:str, client_id:str, client_secret:str, api_base_url:str, client:API_Client=None) -> dict:
+	client = client or get_api_client()
 
-def gen_access_token(token_url:str, client_id:str, client_secret:str, api_base_url:str):
 	try:
-		token_request = requests.post(
+		token_request = client.post(
 			token_url,
 			data={
 				'grant_type': 'client_credentials',
@@ -13,26 +95,234 @@ def gen_access_token(token_url:str, client_id:str, client_secret:str, api_base_u
 		)
 	except Exception as error:
 		print(f"Unable to request access token for '{api_base_url}' with client_id '{client_id}'\n{error}")
+		raise
+
+	return client.decode(token_request.content)
 
-	access_token = token_request.json()['access_token']
+def gen_access_token(token_url:str, client_id:str, client_secret:str, api_base_url:str, client:API_Client=None):
+	access_token = request_access_token(token_url, client_id, client_secret, api_base_url, client)['access_token']
 	return access_token
 
-def api_get(access_token:str, api_url:str, content_type:str=None, params:dict=None):
-	headers = {
-		'Authorization': f'Bearer {access_token}'
-	}
+# caches an access token with its expiry and refreshes it shortly before it expires
+# thread-safe, so concurrent page fetches share one token
+class Token_Provider:
+	def __init__(self, token_url:str, client_id:str, client_secret:str, api_base_url:str, refresh_margin:int=60, default_expires_in:int=3600, client:API_Client=None):
+		self.token_url = token_url
+		self.client_id = client_id
+		self.client_secret = client_secret
+		self.api_base_url = api_base_url
+		self.refresh_margin = refresh_margin
+		self.default_expires_in = default_expires_in
+		self.client = client
 
-	if content_type:
-		headers['Content-Type'] = content_type
+		self._lock = threading.Lock()
+		self._access_token = None
+		self._expires_at = 0.0
 
-	try:
-		if params:
-			api_response = requests.get(api_url, headers=headers, params=params)
-		else:
-			api_response = requests.get(api_url, headers=headers, params=params)
-	except Exception as error:
-		print(f"Failed to reach '{api_url}'\n{error}")
-	return (api_response.json())
+	# return a valid access token, requesting a new one if none is cached or it is about to expire
+	def get_token(self) -> str:
+		with self._lock:
+			if self._access_token is None or time.monotonic() >= self._expires_at - self.refresh_margin:
+				self._refresh()
+			return self._access_token
+
+	# drop the cached token so the next get_token() requests a new one
+	# pass the rejected token so a token refreshed by another thread in the meantime is kept
+	def invalidate(self, access_token:str=None):
+		with self._lock:
+			if access_token is None or access_token == self._access_token:
+				self._access_token = None
+
+	def _refresh(self):
+		token_payload = request_access_token(self.token_url, self.client_id, self.client_secret, self.api_base_url, self.client)
+		self._access_token = token_payload['access_token']
+		self._expires_at = time.monotonic() + int(token_payload.get('expires_in') or self.default_expires_in)
+
+_token_providers = {}
+_token_providers_lock = threading.Lock()
+
+# return the token provider shared by every endpoint and custom pipeline in the process
+def get_token_provider(token_url:str, client_id:str, client_secret:str, api_base_url:str) -> Token_Provider:
+	key = (token_url, client_id)
+
+	with _token_providers_lock:
+		if key not in _token_providers:
+			_token_providers[key] = Token_Provider(token_url, client_id, client_secret, api_base_url)
+		return _token_providers[key]
+
+'''
+iSAMS API
+'''
+
+# send an authorised GET request and return the raw response
+# access_token is either a token string or a Token_Provider
+# with a Token_Provider, a 401 response invalidates the token and the request is retried once
+# stats (optional dict) receives the retries, the time spent getting a token (token_seconds) and the bytes received
+def api_request(access_token:str|Token_Provider, api_url:str, content_type:str=None, params:dict=None, client:API_Client=None, stream:bool=False, stats:dict=None) -> requests.Response:
+	client = client or get_api_client()
+	token_provider = access_token if isinstance(access_token, Token_Provider) else None
+	stats = {} if stats is None else stats
+
+	attempts = 2 if token_provider else 1
+	for attempt in range(attempts):
+		token_start = time.perf_counter()
+		token = token_provider.get_token() if token_provider else access_token
+		stats['token_seconds'] = stats.get('token_seconds', 0.0) + time.perf_counter() - token_start
+		headers = {
+			'Authorization': f'Bearer {token}'
+		}
+
+		if content_type:
+			headers['Content-Type'] = content_type
+
+		try:
+			api_response = client.get(api_url, headers=headers, params=params, stream=stream)
+		except Exception as error:
+			print(f"Failed to reach '{api_url}'\n{error}")
+			raise
+
+		if api_response.status_code == 401 and attempt < attempts - 1:
+			print(f"Access token rejected by '{api_url}', refreshing token and retrying")
+			api_response.close()
+			token_provider.invalidate(token)
+			stats['retries'] = stats.get('retries', 0) + 1
+			continue
+		break
+
+	# streamed bodies are counted by the caller as they are read
+	if not stream:
+		stats['bytes'] = stats.get('bytes', 0) + len(api_response.content)
+	return api_response
+
+# raw payload of a GET request, read from / recorded to the client's response cache
+def api_get_raw(access_token:str|Token_Provider, api_url:str, content_type:str=None, params:dict=None, client:API_Client=None, stats:dict=None) -> bytes:
+	client = client or get_api_client()
+	cache = client.cache
+
+	if cache is not None and cache.replay:
+		content = cache.get(api_url, params)
+		if content is None:
+			raise LookupError(f"'{api_url}' with params {params} is not cached for run {cache.run_id}")
+		if stats is not None:
+			stats['bytes'] = stats.get('bytes', 0) + len(content)
+		return content
+
+	api_response = api_request(access_token, api_url, content_type, params, client, stats=stats)
+	if cache is not None and api_response.status_code == 200:
+		cache.put(api_url, params, api_response.content)
+	return api_response.content
+
+def api_get(access_token:str|Token_Provider, api_url:str, content_type:str=None, params:dict=None, client:API_Client=None, stats:dict=None):
+	client = client or get_api_client()
+	return client.decode(api_get_raw(access_token, api_url, content_type, params, client, stats))
+
+# GET a page and decode the list under object_key straight into per-column buffers
+# returns (columns, meta): columns is {column name: list of values}, meta holds the top-level scalars (totalCount, message, ...)
+# columns lists the expected column names (e.g. from the BigQuery schema), unseen keys are added as they appear
+def api_get_columns(access_token:str|Token_Provider, api_url:str, object_key:str, columns:list=None, content_type:str=None, params:dict=None, client:API_Client=None, stats:dict=None):
+	client = client or get_api_client()
+	stats = {} if stats is None else stats
+
+	# cached payloads are already in memory, stream-decode them from there
+	if client.cache is not None:
+		content = api_get_raw(access_token, api_url, content_type, params, client, stats)
+		if ijson is None:
+			return payload_to_columns(client.decode(content), object_key, columns)
+		return stream_to_columns(io.BytesIO(content), object_key, columns)
+
+	api_response = api_request(access_token, api_url, content_type, params, client, stream=ijson is not None, stats=stats)
+
+	with api_response:
+		if ijson is None:
+			return payload_to_columns(client.decode(api_response.content), object_key, columns)
+
+		# let urllib3 undo the gzip encoding while ijson reads the body
+		api_response.raw.decode_content = True
+		decoded = stream_to_columns(api_response.raw, object_key, columns)
+		# bytes read off the wire (compressed size)
+		stats['bytes'] = stats.get('bytes', 0) + api_response.raw.tell()
+		return decoded
+
+# incrementally parse a JSON body (file-like) into per-column buffers without building a dict per row
+# keys are tracked from map_key events and the nesting depth, so keys containing '.' are kept
+# depth: 1 = top-level object, 2 = endpoint object (list of rows), 3 = a row, 4+ = a nested value inside a row
+def stream_to_columns(body, object_key:str, columns:list=None):
+	buffers = {column: [] for column in (columns or [])}
+	meta = {}
+
+	n_rows = 0
+	depth = 0
+	top_key = None
+	key = None
+	builder = None
+	for _, event, value in ijson.parse(body, use_float=True):
+		# nested value (object/list) inside a row: build it, then store it as one cell
+		if builder is not None:
+			builder.event(event, value)
+			if event in ('start_map', 'start_array'):
+				depth += 1
+			elif event in ('end_map', 'end_array'):
+				depth -= 1
+				if depth == 3:
+					_set_cell(buffers, key, builder.value, n_rows)
+					builder = None
+			continue
+
+		if event == 'map_key':
+			if depth == 1:
+				top_key = value
+			elif depth == 3:
+				key = value
+			continue
+
+		if depth == 1 and top_key == object_key:
+			meta[object_key] = True
+		elif depth == 1 and event in ('string', 'number', 'boolean', 'null'):
+			meta[top_key] = value
+		elif depth == 3 and top_key == object_key:
+			if event in ('start_map', 'start_array'):
+				# value of a top-level field in the current row
+				builder = ijson.ObjectBuilder()
+				builder.event(event, value)
+			elif event == 'end_map':
+				n_rows += 1
+				# pad columns missing from this row
+				for buffer in buffers.values():
+					if len(buffer) < n_rows:
+						buffer.append(None)
+			else:
+				_set_cell(buffers, key, value, n_rows)
+
+		if event in ('start_map', 'start_array'):
+			depth += 1
+		elif event in ('end_map', 'end_array'):
+			depth -= 1
+
+	return buffers, meta
+
+# distribute an already decoded payload into per-column buffers (used when ijson is not installed)
+def payload_to_columns(payload:dict, object_key:str, columns:list=None):
+	buffers = {column: [] for column in (columns or [])}
+	meta = {key: value for key, value in payload.items() if not isinstance(value, (dict, list))}
+
+	rows = payload.get(object_key)
+	if rows is None:
+		return buffers, meta
+	meta[object_key] = True
+
+	for n_rows, row in enumerate(rows):
+		for key, value in row.items():
+			_set_cell(buffers, key, value, n_rows)
+		for buffer in buffers.values():
+			if len(buffer) <= n_rows:
+				buffer.append(None)
+
+	return buffers, meta
+
+def _set_cell(buffers:dict, key:str, value, n_rows:int):
+	if key not in buffers:
+		buffers[key] = [None] * n_rows
+	buffers[key].append(value)
 
 '''
 def is_nested_field(field_value:Any):
@@ -44,4 +334,4 @@ def is_nested_field(field_value:Any):
 		status = True
 
 	return status
-'''
\ No newline at end of file
+'''
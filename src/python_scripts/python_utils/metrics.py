@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import threading
+from datetime import datetime
+from contextlib import contextmanager, nullcontext
+
+# JSON lines file next to /var/log/isams_pipeline.log - override with ISAMS_METRICS_PATH
+METRICS_PATH = os.environ.get('ISAMS_METRICS_PATH', '/var/log/isams_pipeline_metrics.jsonl')
+
+# stages of an endpoint run, in pipeline order - records of any other stage are rejected
+STAGES = ['token', 'fetch', 'decode', 'build', 'transform', 'load_submit', 'load_wait']
+
+'''
+Pipeline metrics
+
+Every endpoint run records duration, rows, bytes and retries per stage. One record is written per page
+and one summary per endpoint, e.g.
+	{"type": "page", "run_id": ..., "endpoint": "students", "offset": 2000, "page_size": 1000, "page": 3, "rows": 1000, "stages": {"fetch": {"duration": 0.41, ...}, ...}}
+	{"type": "endpoint", "run_id": ..., "endpoint": "students", "status": "success", "duration": 52.3, "stages": {...}}
+Pages are keyed by their first row (offset), since page numbers repeat when the page size changes during a run.
+Load jobs cover many pages, so load_submit and load_wait are only in the endpoint summary.
+'''
+
+# appends records as JSON lines, shared by every endpoint in the run
+# metrics must never fail the pipeline: if the file cannot be written, a warning is printed and writing stops
+class Metrics_Log:
+	def __init__(self, path:str=METRICS_PATH):
+		self.path = path
+		self._lock = threading.Lock()
+		self._disabled = False
+
+	def write(self, record:dict):
+		line = json.dumps(record, default=str) + '\n'
+		with self._lock:
+			if self._disabled:
+				return
+			try:
+				with open(self.path, 'a', encoding='utf-8') as file:
+					file.write(line)
+			except OSError as error:
+				self._disabled = True
+				print(f"Unable to write metrics to '{self.path}', metrics are disabled for this run\n{error}")
+
+# a misspelt stage name would silently start a new column in the metrics
+def _check_stage(stage:str):
+	if stage not in STAGES:
+		raise ValueError(f"Unknown metrics stage '{stage}', expected one of {STAGES}")
+
+def _empty_stage() -> dict:
+	return {'duration': 0.0, 'calls': 0, 'rows': 0, 'bytes': 0, 'retries': 0}
+
+def _add_stage(stages:dict, stage:str, duration:float, rows:int, num_bytes:int, retries:int):
+	totals = stages.setdefault(stage, _empty_stage())
+	totals['duration'] += duration
+	totals['calls'] += 1
+	totals['rows'] += rows
+	totals['bytes'] += num_bytes
+	totals['retries'] += retries
+
+# per-stage totals of one endpoint run, thread-safe so concurrent page fetches can record into it
+class Endpoint_Metrics:
+	def __init__(self, endpoint:str, run_id:str=None, log:Metrics_Log=None):
+		self.endpoint = endpoint
+		self.run_id = run_id
+		self.log = log
+		self.stages = {}
+		self.started = datetime.now()
+
+		self._start_time = time.perf_counter()
+		self._lock = threading.Lock()
+		self._pages = {}
+
+	# offset: first row of the page the stage belongs to, None for stages outside a page
+	def record(self, stage:str, duration:float, offset:int=None, rows:int=0, bytes:int=0, retries:int=0):
+		_check_stage(stage)
+		with self._lock:
+			_add_stage(self.stages, stage, duration, rows, bytes, retries)
+			if offset is not None:
+				_add_stage(self._pages.setdefault(offset, {}), stage, duration, rows, bytes, retries)
+
+	# time a block as one stage, the yielded dict takes its rows, bytes and retries
+	# time spent getting an access token inside the block (token_seconds, set by api_request) is recorded as the token stage
+	@contextmanager
+	def stage(self, stage:str, offset:int=None):
+		# checked before the block runs, so a bad name never hides an error raised inside it
+		_check_stage(stage)
+		stats = {}
+		start_time = time.perf_counter()
+		try:
+			yield stats
+		finally:
+			duration = time.perf_counter() - start_time
+			token_seconds = stats.get('token_seconds', 0.0)
+			if token_seconds:
+				self.record('token', token_seconds, offset)
+			self.record(stage, duration - token_seconds, offset, stats.get('rows', 0), stats.get('bytes', 0), stats.get('retries', 0))
+
+	# write the record of the page starting at offset once all its stages are done
+	def end_page(self, offset:int, **fields):
+		with self._lock:
+			stages = self._pages.pop(offset, {})
+		self._write({'type': 'page', 'offset': offset, **fields, 'stages': stages})
+
+	# write the endpoint summary and return it
+	def summary(self, status:str, error:Exception=None) -> dict:
+		duration = time.perf_counter() - self._start_time
+		with self._lock:
+			stages = {stage: dict(totals) for stage, totals in self.stages.items()}
+
+		rows = stages.get('transform', _empty_stage())['rows']
+		record = {
+			'type': 'endpoint',
+			'status': status,
+			'error': f'{type(error).__name__}: {error}' if error is not None else None,
+			'start': self.started,
+			'duration': duration,
+			'rows': rows,
+			'rows_per_sec': rows / duration if duration else 0.0,
+			'stages': stages,
+		}
+		self._write(record)
+		return record
+
+	def _write(self, record:dict):
+		if self.log is not None:
+			self.log.write({'run_id': self.run_id, 'endpoint': self.endpoint, 'time': datetime.now(), **record})
+
+# metrics.stage(...) when metrics are collected, a no-op block otherwise
+def timed(metrics:Endpoint_Metrics, stage:str, offset:int=None):
+	if metrics is None:
+		return nullcontext({})
+	return metrics.stage(stage, offset)
@@ -1,52 +1,117 @@
 import pandas as pd
 
+# guess_datetime_format is public from pandas 2.2, fall back to the internal location on older versions
+try:
+	from pandas.tseries.api import guess_datetime_format
+except ImportError:
+	from pandas._libs.tslibs.parsing import guess_datetime_format
+
 TIMEZONE = 'Asia/Singapore'
 
-def parse_datetime_utc8(date_col:pd.Series) -> pd.Series:
-	date_col = pd.to_datetime(date_col, utc=True, errors="coerce")
+def parse_datetime_utc8(date_col:pd.Series, date_format:str=None) -> pd.Series:
+	date_col = pd.to_datetime(date_col, utc=True, errors="coerce", format=date_format)
 	return date_col.dt.tz_convert(TIMEZONE)
 
-def applicants_mod(applicants_df:pd.DataFrame):
-	date_cols = ['dateOfBirth', 'enquiryDate', 'enrolmentDate', 'lastUpdated', 'registeredDate', 'withdrawnDate']
-	
-	for date_col in date_cols:
-		applicants_df[date_col] = parse_datetime_utc8(applicants_df[date_col])
+'''
+Schema-driven transforms
+
+Column types are coerced from the BigQuery schema of the endpoint (formats.py), so adding an endpoint only
+needs a schema. The converters for a schema are built once and reused for every page.
+'''
+
+# infer an explicit strftime format from the first non-null value, None if it cannot be inferred
+def infer_datetime_format(col:pd.Series):
+	sample = col.dropna()
+	if sample.empty or not isinstance(sample.iloc[0], str):
+		return None
+	return guess_datetime_format(sample.iloc[0])
+
+# DATETIME/TIMESTAMP/DATE -> tz-aware datetime in TIMEZONE
+def _to_datetime(col:pd.Series) -> pd.Series:
+	if isinstance(col.dtype, pd.DatetimeTZDtype):
+		return col.dt.tz_convert(TIMEZONE)
+
+	date_format = infer_datetime_format(col)
+	parsed = parse_datetime_utc8(col, date_format)
+
+	# values that do not share the first value's format (e.g. missing fractional seconds): let pandas infer per value
+	if date_format and parsed.isna().sum() > col.isna().sum():
+		parsed = parse_datetime_utc8(col)
+	return parsed
 
-	return applicants_df
+# INTEGER -> nullable Int64, left as numeric if the values are not whole numbers
+def _to_int(col:pd.Series) -> pd.Series:
+	col = pd.to_numeric(col, errors='coerce')
+	try:
+		return col.astype('Int64')
+	except (TypeError, ValueError):
+		return col
 
-def school_terms_mod(terms_df:pd.DataFrame):
-	date_cols = ['finishDate', 'startDate']
+def _to_float(col:pd.Series) -> pd.Series:
+	return pd.to_numeric(col, errors='coerce')
 
-	for date_col in date_cols:
-		terms_df[date_col] = parse_datetime_utc8(terms_df[date_col])
+# BOOLEAN -> nullable boolean, string values ('true'/'false') are mapped first
+def _to_bool(col:pd.Series) -> pd.Series:
+	try:
+		return col.astype('boolean')
+	except (TypeError, ValueError):
+		return col.map(
+			lambda value: value.strip().lower() == 'true' if isinstance(value, str) else value
+		).astype('boolean')
 
-	return terms_df
+# REPEATED -> list per row, BigQuery arrays cannot be NULL
+def _as_list(value) -> list:
+	if isinstance(value, list):
+		return value
+	if value is None or (isinstance(value, float) and value != value):
+		return []
+	return [value]
 
-def students_mod(students_df:pd.DataFrame):
-	date_cols = ['dob', 'enrolmentDate', 'lastUpdated', 'leavingDate']
+def _to_repeated(col:pd.Series) -> pd.Series:
+	return col.map(_as_list)
 
-	for date_col in date_cols:
-		students_df[date_col] = parse_datetime_utc8(students_df[date_col])
-	return students_df
+TYPE_CONVERTERS = {
+	'DATETIME': _to_datetime,
+	'TIMESTAMP': _to_datetime,
+	'DATE': _to_datetime,
+	'INTEGER': _to_int,
+	'INT64': _to_int,
+	'FLOAT': _to_float,
+	'FLOAT64': _to_float,
+	'BOOLEAN': _to_bool,
+	'BOOL': _to_bool,
+}
 
-def alumni_mod(alumni_df:pd.DataFrame):
-	date_cols = ['lastUpdated']
+# build the (column, converter) list for a schema
+def build_transforms(schema:list) -> list:
+	transforms = []
+	for field in schema:
+		if field.mode == 'REPEATED':
+			# nested records are passed through as they are
+			if field.field_type not in ('RECORD', 'STRUCT'):
+				transforms.append((field.name, _to_repeated))
+		elif field.field_type in TYPE_CONVERTERS:
+			transforms.append((field.name, TYPE_CONVERTERS[field.field_type]))
+	return transforms
 
-	for date_col in date_cols:
-		alumni_df[date_col] = parse_datetime_utc8(alumni_df[date_col])
+# converters per schema, keyed by the id of the schema list
+_transforms_cache = {}
 
-	return alumni_df
+def get_transforms(schema:list) -> list:
+	cached = _transforms_cache.get(id(schema))
+	if cached is None or cached[0] is not schema:
+		cached = (schema, build_transforms(schema))
+		_transforms_cache[id(schema)] = cached
+	return cached[1]
 
-def year_group_mod(year_grp_df:pd.DataFrame):
-	year_grp_df['lastUpdated'] = parse_datetime_utc8(year_grp_df['lastUpdated'])
-	return year_grp_df
+# coerce every schema column of the dataframe in one pass
+# null_cols are columns that are always loaded as NULL
+def transform_df(df:pd.DataFrame, schema:list, null_cols:list=None) -> pd.DataFrame:
+	for col, converter in get_transforms(schema):
+		if col in df.columns:
+			df[col] = converter(df[col])
 
-def billing_cycles_mod(billing_df:pd.DataFrame):
-	date_cols = ['earlyPaymentDate', 'startDate']
+	for col in (null_cols or []):
+		df[col] = None
 
-	for date_col in date_cols:	
-		billing_df[date_col] = parse_datetime_utc8(billing_df[date_col])
-	
-	billing_df['endDate'] = None
-	
-	return billing_df
+	return df
@@ -0,0 +1,94 @@
+import pandas as pd
+from google.cloud import bigquery as bq
+from python_utils.modify_cols import transform_df
+
+'''
+Nested fields
+
+Fields of an endpoint that hold an object or a list of objects can be split out of every page into a child table,
+one row per object, carrying the key of the parent row. They are declared with a 'nested_fields' entry in
+isams_dataset_endpoints, e.g.
+	'nested_fields': {
+		'homeAddresses': {
+			'table_id': 'taylors-data-poc.isams_data.student_home_addresses',
+			'parent_key': {'id': 'studentId'}, # parent column: child column, or a list of parent columns
+		},
+	},
+The child schema defaults to the parent key columns followed by the sub-fields of the RECORD field in the
+endpoint schema, and can be given with 'schema'. The parent key defaults to the incremental primary key.
+Split fields are dropped from the parent table.
+
+Pages are split with explode and one DataFrame built from the list of objects, not row by row.
+'''
+
+class Nested_Field:
+	def __init__(self, name:str, config:dict, schema:list, default_key:list=None):
+		self.name = name
+		self.table_id = config['table_id']
+		self.staging_table_id = config.get('staging_table_id', f"{config['table_id']}_staging")
+
+		parent_key = config.get('parent_key', default_key)
+		if not parent_key:
+			raise ValueError(f"nested field '{name}' needs a parent_key")
+		self.parent_key = dict(parent_key) if isinstance(parent_key, dict) else {col: col for col in parent_key}
+
+		fields = {field.name: field for field in schema}
+		field = fields.get(name)
+		self.repeated = field.mode == 'REPEATED' if field is not None else None
+
+		if config.get('schema'):
+			self.schema = config['schema']
+		elif field is not None and field.field_type in ('RECORD', 'STRUCT'):
+			key_fields = [bq.SchemaField(child_col, fields[parent_col].field_type, mode='NULLABLE') for parent_col, child_col in self.parent_key.items()]
+			self.schema = key_fields + list(field.fields)
+		else:
+			raise ValueError(f"nested field '{name}' is not a RECORD in the endpoint schema, give its child table a schema")
+
+		collisions = set(self.parent_key.values()) & {field.name for field in self.schema[len(self.parent_key):]}
+		if not config.get('schema') and collisions:
+			raise ValueError(f"parent key columns {sorted(collisions)} of nested field '{name}' clash with its sub-fields, map them to other names in parent_key")
+
+	# one row per object of the field, with the parent key, typed by the child schema
+	def split(self, df:pd.DataFrame) -> pd.DataFrame:
+		columns = [field.name for field in self.schema]
+		if self.name not in df.columns or df.empty:
+			return pd.DataFrame(columns=columns)
+
+		col = df[self.name]
+		repeated = self.repeated
+		if repeated is None:
+			first = col.dropna()
+			repeated = not first.empty and isinstance(first.iloc[0], list)
+
+		# lists become one row per item (empty lists become NaN), a single object stays one row
+		if repeated:
+			col = col.map(lambda value: [value] if isinstance(value, dict) else value).explode()
+		objects = col.dropna()
+		if objects.empty:
+			return pd.DataFrame(columns=columns)
+
+		keys = df[list(self.parent_key)].iloc[df.index.get_indexer(objects.index)].rename(columns=self.parent_key)
+		child_df = pd.concat([
+			keys.reset_index(drop=True),
+			pd.DataFrame(objects.tolist()),
+		], axis=1)
+
+		return transform_df(child_df.reindex(columns=columns), self.schema)
+
+# nested fields declared for an endpoint, [] if none
+def nested_fields(endpoint_info:dict) -> list:
+	config = endpoint_info.get('nested_fields') or {}
+	default_key = (endpoint_info.get('incremental') or {}).get('primary_key')
+	return [Nested_Field(name, field_config, endpoint_info['schema'], default_key) for name, field_config in config.items()]
+
+# endpoint schema without the split fields
+def parent_schema(schema:list, nested:list) -> list:
+	names = {field.name for field in nested}
+	return [field for field in schema if field.name not in names]
+
+# split a transformed page into the parent DataFrame and one child DataFrame per nested field
+def split_nested(df:pd.DataFrame, nested:list) -> tuple:
+	if not nested:
+		return df, {}
+	child_dfs = {field.name: field.split(df) for field in nested}
+	return df.drop(columns=[field.name for field in nested], errors='ignore'), child_dfs
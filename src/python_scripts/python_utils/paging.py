@@ -0,0 +1,115 @@
+import threading
+from python_utils.state import load_state, save_state
+
+'''
+Adaptive page size
+
+Page sizes are on a ladder (min_page_size doubled up to max_page_size), so the number of rows already fetched
+is always a whole number of pages at any smaller size on the ladder. The size grows while pages come back well
+under target_seconds and max_page_bytes, and shrinks when a page is slower or larger than that. The size with
+the best observed throughput is remembered per endpoint and used to start the next run.
+
+A replay of a cached run (Recorded_Page_Size) sends the requests of the recorded run instead, with the page
+size recorded at every offset, since cached responses are keyed by their pageSize.
+
+Endpoints can override the defaults with a 'paging' entry in isams_dataset_endpoints, e.g.
+	'paging': {'page_size': 1000, 'min_page_size': 250, 'max_page_size': 8000},
+'''
+
+PAGE_SIZE_STATE = 'page_sizes'
+
+DEFAULT_PAGING = {
+	'page_size': 1000, # first run, before a size is remembered
+	'min_page_size': 250,
+	'max_page_size': 8000,
+	'target_seconds': 5.0, # slowest acceptable page
+	'max_page_bytes': 16 * 1024 * 1024,
+}
+
+class Adaptive_Page_Size:
+	def __init__(self, endpoint:str, paging:dict=None):
+		config = {**DEFAULT_PAGING, **(paging or {})}
+
+		self.endpoint = endpoint
+		self.target_seconds = config['target_seconds']
+		self.max_page_bytes = config['max_page_bytes']
+
+		self.ladder = [config['min_page_size']]
+		while self.ladder[-1] * 2 <= config['max_page_size']:
+			self.ladder.append(self.ladder[-1] * 2)
+
+		# start from the remembered size, snapped onto the ladder in case the limits changed
+		stored = load_state(PAGE_SIZE_STATE, endpoint)
+		self.page_size = self.snap(stored['page_size'] if stored else config['page_size'])
+
+		# size: [pages, rows, seconds] for the pages observed in this run
+		self.observed = {}
+		self._lock = threading.Lock()
+
+	# largest ladder size not above page_size
+	def snap(self, page_size:int) -> int:
+		return max([size for size in self.ladder if size <= page_size] or self.ladder[:1])
+
+	# record a full page and pick the size of the next request, thread-safe for parallel page fetches
+	def observe(self, page_size:int, rows:int, seconds:float, num_bytes:int):
+		index = self.ladder.index(self.snap(page_size))
+		if seconds > self.target_seconds or num_bytes > self.max_page_bytes:
+			index = max(index - 1, 0)
+		elif seconds * 2 <= self.target_seconds and num_bytes * 2 <= self.max_page_bytes:
+			index = min(index + 1, len(self.ladder) - 1)
+
+		with self._lock:
+			stats = self.observed.setdefault(page_size, [0, 0, 0.0])
+			stats[0] += 1
+			stats[1] += rows
+			stats[2] += seconds
+			self.page_size = self.ladder[index]
+
+	# size for the page starting at offset: a larger size is only used once offset is a whole number of its pages
+	def size_at(self, offset:int) -> int:
+		page_size = self.page_size
+		while offset % page_size and page_size > self.ladder[0]:
+			page_size //= 2
+		return page_size
+
+	# (offset, page size) of the pages from offset up to total_count for parallel fetches, all at the size for offset
+	def pages_from(self, offset:int, total_count:int):
+		page_size = self.size_at(offset)
+		for page_offset in range(offset, total_count, page_size):
+			yield page_offset, page_size
+
+	# size with the best observed rows/sec among the sizes whose pages met target_seconds on average
+	# the smallest observed size if none did, None if no full page was observed
+	def best_page_size(self):
+		if not self.observed:
+			return None
+
+		within_target = [size for size, (pages, _, seconds) in self.observed.items() if seconds / pages <= self.target_seconds]
+		if not within_target:
+			return min(self.observed)
+		return max(within_target, key=lambda size: self.observed[size][1] / max(self.observed[size][2], 1e-9))
+
+	# remember the best size for the next run
+	def save(self):
+		best = self.best_page_size()
+		if best is not None:
+			save_state(PAGE_SIZE_STATE, self.endpoint, {'page_size': best, 'observed': self.observed})
+
+# page sizes of a recorded run, {offset: page size}, for replaying its cached responses
+# the sizes are fixed, so nothing is observed or saved during a replay
+class Recorded_Page_Size(Adaptive_Page_Size):
+	def __init__(self, endpoint:str, recorded:dict, paging:dict=None):
+		super().__init__(endpoint, paging)
+		self.recorded = recorded
+
+	def size_at(self, offset:int) -> int:
+		if offset not in self.recorded:
+			raise LookupError(f'No request at row {offset} of {self.endpoint} was recorded')
+		return self.recorded[offset]
+
+	# the recorded pages follow each other, whatever their sizes
+	def pages_from(self, offset:int, total_count:int):
+		while offset < total_count:
+			page_size = self.size_at(offset)
+			yield offset, page_size
+			offset += page_size
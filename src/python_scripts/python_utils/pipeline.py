@@ -0,0 +1,104 @@
+import queue
+import threading
+
+'''
+Staged pipeline
+
+Runs a source, a chain of stages and a sink at the same time, connected by bounded queues:
+	source -> queue -> stage -> queue -> ... -> sink
+Each stage runs in its own thread and handles one item at a time, so items reach the sink in source order.
+A full queue blocks the stage feeding it (backpressure), so at most queue_size items wait between two stages.
+If any part fails, every other part stops at its next queue operation and the first error is raised.
+'''
+
+# how often a blocked queue operation checks for cancellation, in seconds
+POLL_INTERVAL = 0.2
+
+# marks the end of a stage's input
+_END = object()
+
+class Pipeline_Cancelled(Exception):
+	pass
+
+class Pipeline:
+	def __init__(self, queue_size:int=4, name:str='pipeline'):
+		self.queue_size = queue_size
+		self.name = name
+		self.cancelled = threading.Event()
+		self.errors = []
+		self._lock = threading.Lock()
+
+	# source is an iterable (e.g. a generator of pages), every stage is a function of one item returning the next item
+	# sink is called with every item leaving the last stage, in the calling thread
+	def run(self, source, stages:list, sink):
+		queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(stages) + 1)]
+		threads = [threading.Thread(target=self._run_source, args=(source, queues[0]), name=f'{self.name}-source', daemon=True)]
+		for index, stage in enumerate(stages):
+			threads.append(threading.Thread(target=self._run_stage, args=(stage, queues[index], queues[index + 1]), name=f'{self.name}-stage-{index + 1}', daemon=True))
+
+		for thread in threads:
+			thread.start()
+
+		try:
+			while (item := self._get(queues[-1])) is not _END:
+				sink(item)
+		except Pipeline_Cancelled:
+			pass
+		except BaseException as error:
+			self._fail(error)
+		finally:
+			# stop the other threads (a no-op when every stage has finished) and wait for them
+			self.cancelled.set()
+			for thread in threads:
+				thread.join()
+
+		if self.errors:
+			raise self.errors[0]
+
+	def _fail(self, error:BaseException):
+		with self._lock:
+			self.errors.append(error)
+		self.cancelled.set()
+
+	def _put(self, out_queue:queue.Queue, item):
+		while not self.cancelled.is_set():
+			try:
+				out_queue.put(item, timeout=POLL_INTERVAL)
+				return
+			except queue.Full:
+				continue
+		raise Pipeline_Cancelled()
+
+	def _get(self, in_queue:queue.Queue):
+		while not self.cancelled.is_set():
+			try:
+				return in_queue.get(timeout=POLL_INTERVAL)
+			except queue.Empty:
+				continue
+		raise Pipeline_Cancelled()
+
+	def _run_source(self, source, out_queue:queue.Queue):
+		items = iter(source)
+		try:
+			for item in items:
+				self._put(out_queue, item)
+			self._put(out_queue, _END)
+		except Pipeline_Cancelled:
+			pass
+		except BaseException as error:
+			self._fail(error)
+		finally:
+			# generators are closed in the thread that ran them, e.g. to cancel pending page fetches
+			close = getattr(items, 'close', None)
+			if close:
+				close()
+
+	def _run_stage(self, stage, in_queue:queue.Queue, out_queue:queue.Queue):
+		try:
+			while (item := self._get(in_queue)) is not _END:
+				self._put(out_queue, stage(item))
+			self._put(out_queue, _END)
+		except Pipeline_Cancelled:
+			pass
+		except BaseException as error:
+			self._fail(error)
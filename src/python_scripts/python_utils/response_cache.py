@@ -0,0 +1,109 @@
+import os
+import gzip
+import json
+import time
+import hashlib
+
+'''
+Raw response cache
+
+Stores raw API payloads (gzip-compressed) on local disk, keyed by endpoint URL, request params and run ID.
+In replay mode, payloads are read back from the cache instead of calling the API, so a run can be
+re-transformed and reloaded without any API calls. The requests of multi-page endpoints (the page size at every
+offset and the extra params) are stored with the run, so a replay sends exactly the requests that were cached.
+'''
+
+class Response_Cache:
+	def __init__(self, cache_dir:str, run_id:str, max_bytes:int=2 * 1024**3, max_age:int=7 * 24 * 3600, replay:bool=False):
+		self.cache_dir = cache_dir
+		self.run_id = run_id
+		self.max_bytes = max_bytes
+		self.max_age = max_age
+		self.replay = replay
+
+		os.makedirs(self.cache_dir, exist_ok=True)
+		if not replay:
+			self.evict()
+
+	# stable key for a request
+	def key(self, api_url:str, params:dict=None) -> str:
+		raw_key = json.dumps([api_url, sorted((params or {}).items()), self.run_id], default=str)
+		return hashlib.sha256(raw_key.encode('utf-8')).hexdigest()
+
+	# entries are grouped per run: cache_dir/run_id/key.json.gz
+	def path(self, api_url:str, params:dict=None) -> str:
+		return os.path.join(self.cache_dir, self.run_id, f'{self.key(api_url, params)}.json.gz')
+
+	# return the cached payload (bytes), None if it is not cached
+	def get(self, api_url:str, params:dict=None):
+		path = self.path(api_url, params)
+		if not os.path.isfile(path):
+			return None
+
+		with gzip.open(path, 'rb') as file:
+			return file.read()
+
+	def put(self, api_url:str, params:dict, content:bytes) -> None:
+		path = self.path(api_url, params)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+
+		tmp_path = f'{path}.tmp'
+		with gzip.open(tmp_path, 'wb', compresslevel=5) as file:
+			file.write(content)
+		os.replace(tmp_path, path)
+
+	# requests of a multi-page endpoint in this run: {'page_sizes': {offset: page size}, 'params': extra request params}
+	# stored as cache_dir/run_id/requests/endpoint.json
+	def requests_path(self, endpoint:str) -> str:
+		return os.path.join(self.cache_dir, self.run_id, 'requests', f'{endpoint}.json')
+
+	def save_requests(self, endpoint:str, page_sizes:dict, params:dict=None) -> None:
+		path = self.requests_path(endpoint)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+
+		tmp_path = f'{path}.tmp'
+		with open(tmp_path, 'w', encoding='utf-8') as file:
+			json.dump({'page_sizes': page_sizes, 'params': params or {}}, file, default=str)
+		os.replace(tmp_path, path)
+
+	# recorded requests of a multi-page endpoint, None if none were recorded
+	def load_requests(self, endpoint:str):
+		path = self.requests_path(endpoint)
+		if not os.path.isfile(path):
+			return None
+
+		with open(path, 'r', encoding='utf-8') as file:
+			requests = json.load(file)
+		# JSON object keys are strings
+		requests['page_sizes'] = {int(offset): page_size for offset, page_size in requests['page_sizes'].items()}
+		return requests
+
+	# remove entries older than max_age, then the oldest entries until the cache fits in max_bytes
+	def evict(self) -> None:
+		now = time.time()
+		entries = []
+
+		for dir_path, _, file_names in os.walk(self.cache_dir):
+			for file_name in file_names:
+				file_path = os.path.join(dir_path, file_name)
+				try:
+					file_stat = os.stat(file_path)
+				except FileNotFoundError:
+					continue
+
+				if now - file_stat.st_mtime > self.max_age:
+					os.remove(file_path)
+				else:
+					entries.append((file_stat.st_mtime, file_stat.st_size, file_path))
+
+		total_bytes = sum(size for _, size, _ in entries)
+		for _, size, file_path in sorted(entries):
+			if total_bytes <= self.max_bytes:
+				break
+			os.remove(file_path)
+			total_bytes -= size
+
+		# drop folders left empty, deepest first
+		for dir_path, _, _ in os.walk(self.cache_dir, topdown=False):
+			if dir_path != self.cache_dir and not os.listdir(dir_path):
+				os.rmdir(dir_path)
@@ -0,0 +1,41 @@
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+'''
+Endpoint scheduler
+'''
+
+# run independent jobs concurrently and return a result per job
+# jobs is a list of (name, priority, callable); higher priority jobs are started first
+# a job can return its status (e.g. 'unchanged'), 'success' otherwise; a job that raises is 'failed'
+# at most max_workers jobs run at the same time; a failing job does not stop the others
+def run_scheduled(jobs:list, max_workers:int) -> dict:
+	# the executor starts queued jobs in submission order
+	ordered = sorted(jobs, key=lambda job: job[1], reverse=True)
+
+	results = {}
+	with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+		futures = {executor.submit(_run_job, job_func): name for name, _, job_func in ordered}
+		for future in as_completed(futures):
+			results[futures[future]] = future.result()
+
+	# report in start order
+	return {name: results[name] for name, _, _ in ordered}
+
+# run one job, capturing its outcome instead of raising
+def _run_job(job_func) -> dict:
+	start = datetime.now()
+	start_time = time.perf_counter()
+
+	try:
+		status, error = job_func() or 'success', None
+	except Exception as job_error:
+		status, error = 'failed', job_error
+
+	return {
+		'status': status,
+		'error': error,
+		'start': start,
+		'duration': time.perf_counter() - start_time,
+	}
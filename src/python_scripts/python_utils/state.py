@@ -0,0 +1,33 @@
+import os
+import json
+
+# local directory for run state (watermarks, checkpoints, ...) - override with ISAMS_STATE_DIR
+STATE_DIR = os.environ.get('ISAMS_STATE_DIR', '/home/isams_pipeline/state')
+
+# path of the state file for one endpoint, e.g. STATE_DIR/watermarks/students.json
+def state_path(kind:str, name:str) -> str:
+	return os.path.join(STATE_DIR, kind, f'{name}.json')
+
+# read a state file, returns None if it does not exist
+def load_state(kind:str, name:str):
+	path = state_path(kind, name)
+	if not os.path.isfile(path):
+		return None
+
+	with open(path, 'r', encoding='utf-8') as file:
+		return json.load(file)
+
+# write a state file atomically so an interrupted run never leaves a half-written file
+def save_state(kind:str, name:str, data) -> None:
+	path = state_path(kind, name)
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+
+	tmp_path = f'{path}.tmp'
+	with open(tmp_path, 'w', encoding='utf-8') as file:
+		json.dump(data, file, indent='\t', default=str)
+	os.replace(tmp_path, path)
+
+def clear_state(kind:str, name:str) -> None:
+	path = state_path(kind, name)
+	if os.path.isfile(path):
+		os.remove(path)
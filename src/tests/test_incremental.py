@@ -0,0 +1,42 @@
+import os
+import sys
+import pandas as pd
+from google.cloud import bigquery as bq
+
+# python_utils lives next to this folder in src/python_scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python_scripts'))
+import python_utils.state as state
+from python_utils.incremental import Incremental_Load, WATERMARK_STATE
+
+ENDPOINT_INFO = {
+	'table_id': 'project.dataset.students',
+	'schema': [
+		bq.SchemaField('id', 'INTEGER'),
+		bq.SchemaField('lastUpdated', 'TIMESTAMP'),
+	],
+	'incremental': {'primary_key': ['id']},
+}
+
+def incremental_load(tmp_path, monkeypatch, watermark:str) -> Incremental_Load:
+	monkeypatch.setattr(state, 'STATE_DIR', str(tmp_path))
+	state.save_state(WATERMARK_STATE, 'students', {'watermark': watermark})
+	return Incremental_Load('students', ENDPOINT_INFO)
+
+# a row updated in the same second as the watermark may not have been read by the last run
+def test_filter_keeps_rows_at_the_watermark(tmp_path, monkeypatch):
+	load = incremental_load(tmp_path, monkeypatch, '2024-03-01T10:00:00+00:00')
+	df = pd.DataFrame({
+		'id': [1, 2, 3],
+		'lastUpdated': ['2024-03-01T09:59:59Z', '2024-03-01T10:00:00Z', '2024-03-01T10:00:01Z'],
+	})
+
+	assert load.filter(df)['id'].tolist() == [2, 3]
+	assert load.max_seen == pd.Timestamp('2024-03-01T10:00:01Z')
+
+def test_filter_keeps_every_row_without_a_watermark(tmp_path, monkeypatch):
+	monkeypatch.setattr(state, 'STATE_DIR', str(tmp_path))
+	load = Incremental_Load('students', ENDPOINT_INFO)
+	df = pd.DataFrame({'id': [1, 2], 'lastUpdated': ['2024-03-01T09:00:00Z', '2024-03-01T10:00:00Z']})
+
+	assert not load.is_incremental
+	assert load.filter(df)['id'].tolist() == [1, 2]